@@ -20,6 +20,13 @@ import glob
 import re
 import platform
 import datetime
+import uuid
+import time
+import socket
+import threading
+import struct
+import zlib
+import math
 
 # if sys.version_info[0] == 2:
 #     import pathlib2 as pathlib
@@ -43,9 +50,9 @@ except ImportError:
     DEVNULL = open(os.devnull, 'wb')
 
 try:
-    from functools import lru_cache
+    import queue
 except ImportError:
-    from backports.functools_lru_cache import lru_cache
+    import Queue as queue
 
 try:
     import uptime
@@ -141,6 +148,21 @@ def git_working_copy_is_dirty():
         return True
 
 
+def get_git_commit_hash():
+    try:
+        commit_hash = subprocess.Popen(
+         ["git", "rev-parse", "--short", "HEAD"],
+         stdout=subprocess.PIPE,
+        ).communicate()[0].strip()
+    except OSError:
+        return None
+
+    if not isinstance(commit_hash, str):
+        commit_hash = commit_hash.decode('utf-8')
+
+    return commit_hash
+
+
 def merge(a, b, path=None):
     "merges b into a"
     if path is None:
@@ -158,6 +180,95 @@ def merge(a, b, path=None):
     return a
 
 
+try:
+    from time import monotonic as get_monotonic_time
+except ImportError:
+    try:
+        # Jython as used by SikuliX.
+        from java.lang import System
+
+        def get_monotonic_time():
+            return System.nanoTime() / 1e9
+    except ImportError:
+        # Python 2. time.clock is based on QueryPerformanceCounter on Windows.
+        if sys.platform == 'win32':
+            get_monotonic_time = time.clock
+        else:
+            get_monotonic_time = time.time
+
+timer_overhead = []
+
+
+def calibrate_timer_overhead(sample_count=1000):
+    """Return the median seconds between two consecutive `get_monotonic_time` calls."""
+    samples = []
+    for _ in range(sample_count):
+        t1 = get_monotonic_time()
+        t2 = get_monotonic_time()
+        samples.append(t2 - t1)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def get_timer_overhead():
+    if not timer_overhead:
+        timer_overhead.append(calibrate_timer_overhead())
+    return timer_overhead[0]
+
+
+def get_percentile(sorted_values, percent):
+    """Linear interpolation between the closest ranks like numpy.percentile."""
+    rank = (len(sorted_values) - 1) * percent / 100.0
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def get_summary_statistics(values):
+    """Return count, min, median, p90, p95, max and the sample standard deviation of `values`."""
+    sorted_values = sorted(values)
+    count = len(sorted_values)
+    mean = sum(sorted_values) / float(count)
+    if count > 1:
+        stddev = math.sqrt(sum((v - mean) ** 2 for v in sorted_values) / (count - 1))
+    else:
+        stddev = 0.0
+
+    return {
+        'count': count,
+        'min': sorted_values[0],
+        'median': get_percentile(sorted_values, 50),
+        'p90': get_percentile(sorted_values, 90),
+        'p95': get_percentile(sorted_values, 95),
+        'max': sorted_values[-1],
+        'stddev': stddev,
+    }
+
+
+class TimeMeasurement(object):
+    """
+    Measures a duration with the monotonic clock.
+    Call `started` once the instrumentation at the start (like signaling the
+    tray icon) is done and `stop` before the instrumentation at the end. The
+    time between the creation and `started` and the calibrated overhead of
+    reading the clock are not part of `duration`. `raw_duration` includes them.
+    """
+
+    def __init__(self):
+        self.start_time = get_monotonic_time()
+        self.start_overhead = 0.0
+        self.raw_duration = None
+        self.duration = None
+
+    def started(self):
+        self.start_overhead = get_monotonic_time() - self.start_time
+
+    def stop(self):
+        self.raw_duration = get_monotonic_time() - self.start_time
+        self.duration = max(0.0, self.raw_duration - self.start_overhead - get_timer_overhead())
+        return self.duration
+
+
 def get_filename_save_cur_timestamp():
     """ tzlocal nor pytz work on Windows. Retry with Python3 only ref: https://stackoverflow.com/a/27987813"""
     return str(datetime.datetime.now().isoformat()).replace(":", "_").replace(".", "_")
@@ -171,8 +282,13 @@ def get_script_name():
     return os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
 
+def get_var_path():
+    """Root of the cache, spool, working and log directories. Can be overridden for benchmarks on Linux."""
+    return os.environ.get('E2E_TESTS_VAR_PATH', 'c:/var')
+
+
 def get_cache_path():
-    cache_path = 'c:/var/cache/e2e-tests'
+    cache_path = get_var_path() + '/cache/e2e-tests'
     if not os.path.exists(cache_path):
         os.makedirs(cache_path)
 
@@ -180,7 +296,7 @@ def get_cache_path():
 
 
 def get_spool_path():
-    spool_path = 'c:/var/spool/e2e-tests'
+    spool_path = get_var_path() + '/spool/e2e-tests'
     if not os.path.exists(spool_path):
         os.makedirs(spool_path)
 
@@ -188,7 +304,7 @@ def get_spool_path():
 
 
 def get_working_path():
-    working_path = 'c:/var/lib/e2e-tests'
+    working_path = get_var_path() + '/lib/e2e-tests'
     if not os.path.exists(working_path):
         os.makedirs(working_path)
 
@@ -196,7 +312,7 @@ def get_working_path():
 
 
 def get_config_file_path(_try=0):
-    config_path = 'c:/e2e-tests/config'
+    config_path = os.environ.get('E2E_TESTS_CONFIG_PATH', 'c:/e2e-tests/config')
 
     if _try == 1:
         config_path = get_script_path() + '/config'
@@ -218,8 +334,16 @@ def get_config_file_path(_try=0):
     return config_file_path
 
 
+def get_screenshots_root_path():
+    return get_working_path() + '/screenshots'
+
+
+def get_screenshot_index_file_path():
+    return get_screenshots_root_path() + '/index.json'
+
+
 def get_screenshot_path():
-    screenshot_path = get_working_path() + '/screenshots/' + datetime.datetime.now().strftime('%Y/%m/%d')
+    screenshot_path = get_screenshots_root_path() + '/' + datetime.datetime.now().strftime('%Y/%m/%d')
     if not os.path.exists(screenshot_path):
         os.makedirs(screenshot_path)
 
@@ -227,7 +351,7 @@ def get_screenshot_path():
 
 
 def get_log_path():
-    log_path = 'c:/var/log/e2e-tests'
+    log_path = get_var_path() + '/log/e2e-tests'
     if not os.path.exists(log_path):
         os.makedirs(log_path)
 
@@ -268,13 +392,21 @@ def get_login_credentials():
     return json.load(open(login_credentials_file_path))
 
 
-def get_logstash_handler(config, database_path=None):
+def get_logstash_handler(config, database_path=None, max_events_per_second=0):
+    """
+    `max_events_per_second` only applies to `logstash_output_mode=batched`.
+    logstash_async sends from its own worker, so it can only be limited by
+    handing over the events more slowly.
+    """
+    if get_config_option(config, 'Output', 'logstash_output_mode', 'handler') == 'batched':
+        return get_batching_logstash_handler(config, max_events_per_second=max_events_per_second)
+
     if not database_path:
         database_path = get_spool_path() + '/events.db'
 
     logstash_handler = AsynchronousLogstashHandler(
         config.get('Output', 'logstash_host'),
-        config.getint('Output', 'logstash_port'),
+        get_config_value(config, 'Output', 'logstash_port'),
         database_path=database_path,
     )
     logstash_handler.formatter = LogstashFormatter(
@@ -286,14 +418,295 @@ def get_logstash_handler(config, database_path=None):
     return logstash_handler
 
 
-def get_logger(config, name='python-logstash-logger', database_path=None):
+class LogstashConnection(object):
+    """
+    Persistent TCP connection to a Logstash `tcp` input with the `json_lines`
+    codec which can be shared between threads. Reconnects once if sending
+    fails, so events can be delivered twice but are not lost silently.
+    """
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _get_socket(self):
+        if self._sock is None:
+            self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        return self._sock
+
+    def _close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def send(self, event_texts, zlib_framing=False):
+        """
+        Send already formatted events. Returns the number of sent events.
+
+        With `zlib_framing`, the events are sent as one frame: the length of
+        the compressed payload as 4 byte big-endian integer followed by the
+        zlib compressed json_lines. The Logstash `tcp` input can not read this,
+        it needs a receiver which unpacks the frames like
+        ../tools/logstash_stand_in_server.py.
+        """
+        lines = []
+        for event_text in event_texts:
+            if not isinstance(event_text, bytes):
+                event_text = event_text.encode('utf-8')
+            if not event_text.endswith(b'\n'):
+                event_text += b'\n'
+            lines.append(event_text)
+
+        if not lines:
+            return 0
+
+        data = b''.join(lines)
+        if zlib_framing:
+            payload = zlib.compress(data)
+            data = struct.pack('>I', len(payload)) + payload
+
+        with self._lock:
+            try:
+                self._get_socket().sendall(data)
+            except socket.error:
+                self._close_socket()
+                self._get_socket().sendall(data)
+
+        return len(lines)
+
+    def close(self):
+        with self._lock:
+            self._close_socket()
+
+
+def get_logstash_connection(config):
+    return LogstashConnection(
+        config.get('Output', 'logstash_host'),
+        get_config_value(config, 'Output', 'logstash_port'),
+    )
+
+
+class LogstashQueueFullError(Exception):
+    pass
+
+
+class BatchingLogstashSender(object):
+    """
+    Sends events over one persistent `LogstashConnection` from a worker thread.
+    Events are collected into batches of at most `batch_size` events or
+    `batch_max_bytes` bytes which are sent at the latest `flush_interval`
+    seconds after their first event was queued.
+
+    The queue is bounded. If it stays full for `put_timeout` seconds, `put`
+    raises LogstashQueueFullError so that the caller can leave the
+    remaining events in the spool (backpressure). Failed batches are retried
+    with backoff until the sender is closed.
+    With `max_events_per_second`, batches are held back so that the
+    connection is not used for more than that on average.
+    """
+
+    # Queued by `flush` to end the current batch early.
+    _FLUSH_MARKER = object()
+
+    def __init__(self, connection, batch_size=500, batch_max_bytes=1024 * 1024, flush_interval=1.0,
+                 queue_size=10000, put_timeout=5.0, zlib_framing=False, max_events_per_second=0):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.batch_max_bytes = batch_max_bytes
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.zlib_framing = zlib_framing
+        self.max_events_per_second = max_events_per_second
+        self.sent_count = 0
+        self._first_send_time = None
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending_count = 0
+        self._pending_condition = threading.Condition()
+        self._closed = threading.Event()
+        self._worker_thread = threading.Thread(target=self._run, name='BatchingLogstashSender')
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def put(self, event_text):
+        with self._pending_condition:
+            self._pending_count += 1
+        try:
+            self._queue.put(event_text, timeout=self.put_timeout)
+        except queue.Full:
+            self._mark_done(1)
+            raise LogstashQueueFullError(
+                "Logstash output queue is still full after %s seconds." % self.put_timeout)
+
+    def _mark_done(self, count):
+        with self._pending_condition:
+            self._pending_count -= count
+            self._pending_condition.notify_all()
+
+    def _get_batch(self):
+        """
+        Block until the first event of a batch arrives, then collect until a bound is reached.
+        Returns None when the sender is closed and the queue is empty.
+        """
+        while True:
+            try:
+                event_text = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._closed.is_set():
+                    return None
+                continue
+            if event_text is not self._FLUSH_MARKER:
+                break
+            if self._closed.is_set():
+                return None
+
+        batch = [event_text]
+        batch_bytes = len(event_text)
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size and batch_bytes < self.batch_max_bytes:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                event_text = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if event_text is self._FLUSH_MARKER:
+                break
+            batch.append(event_text)
+            batch_bytes += len(event_text)
+
+        return batch
+
+    def _wait_for_rate_limit(self):
+        if self.max_events_per_second <= 0:
+            return
+        if self._first_send_time is None:
+            self._first_send_time = time.time()
+            return
+
+        ahead_seconds = self.sent_count / float(self.max_events_per_second) - (time.time() - self._first_send_time)
+        if ahead_seconds > 0:
+            time.sleep(ahead_seconds)
+
+    def _send_batch(self, batch):
+        self._wait_for_rate_limit()
+        retry_delay = 1
+        while True:
+            try:
+                self.connection.send(batch, zlib_framing=self.zlib_framing)
+                self.sent_count += len(batch)
+                return
+            except socket.error as err:
+                if self._closed.is_set():
+                    # Unsent events are still in the spool because the caller did not see them flushed.
+                    print("Dropping %d unsent events on close: %s" % (len(batch), err))
+                    return
+                print("Sending to Logstash failed, retrying in %d s: %s" % (retry_delay, err))
+                self._closed.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            if batch is None:
+                return
+            self._send_batch(batch)
+            self._mark_done(len(batch))
+
+    def flush(self, timeout=None):
+        """Send the current batch right away and wait until all queued events are sent. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        if self._pending_count > 0:
+            try:
+                self._queue.put(self._FLUSH_MARKER, timeout=timeout)
+            except queue.Full:
+                return False
+
+        with self._pending_condition:
+            while self._pending_count > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._pending_condition.wait(remaining)
+
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        self._closed.set()
+        try:
+            # Wake up the worker.
+            self._queue.put_nowait(self._FLUSH_MARKER)
+        except queue.Full:
+            pass
+        self._worker_thread.join(timeout)
+        self.connection.close()
+
+
+class BatchingLogstashHandler(logging.Handler):
+    """
+    Logging handler for `logstash_output_mode=batched`. Formats records like
+    the logstash_async handler and passes them to a `BatchingLogstashSender`.
+    Unlike most handlers, `emit` lets LogstashQueueFullError through so that
+    the caller notices the backpressure.
+    """
+
+    def __init__(self, sender, flush_timeout=60, close_timeout=5):
+        logging.Handler.__init__(self)
+        self.sender = sender
+        self.flush_timeout = flush_timeout
+        self.close_timeout = close_timeout
+
+    def emit(self, record):
+        self.sender.put(self.format(record))
+
+    def ensure_flushed(self):
+        """Raises LogstashQueueFullError if the queued events could not be sent in time."""
+        if not self.sender.flush(self.flush_timeout):
+            raise LogstashQueueFullError(
+                "Queued events were not sent within %s seconds." % self.flush_timeout)
+
+    def close(self):
+        self.sender.close(self.close_timeout)
+        logging.Handler.close(self)
+
+
+def get_batching_logstash_handler(config, max_events_per_second=0):
+    sender = BatchingLogstashSender(
+        get_logstash_connection(config),
+        batch_size=get_config_option(config, 'Output', 'logstash_batch_size', 500),
+        batch_max_bytes=get_config_option(config, 'Output', 'logstash_batch_max_bytes', 1024 * 1024),
+        flush_interval=get_config_option(config, 'Output', 'logstash_batch_flush_interval', 1.0),
+        queue_size=get_config_option(config, 'Output', 'logstash_queue_size', 10000),
+        put_timeout=get_config_option(config, 'Output', 'logstash_queue_put_timeout', 5.0),
+        zlib_framing=get_config_option(config, 'Output', 'logstash_zlib_framing', False),
+        max_events_per_second=max_events_per_second,
+    )
+    logstash_handler = BatchingLogstashHandler(sender)
+    logstash_handler.formatter = LogstashFormatter(
+        extra_prefix=None,
+    )
+
+    return logstash_handler
+
+
+def get_logger(config, name='python-logstash-logger', database_path=None, logstash_handler=None):
     if is_running_under_sikulix():
         raise NotImplemented("Not working under Sikulix")
 
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
 
-    logger.addHandler(get_logstash_handler(config, database_path=database_path))
+    if logstash_handler is None:
+        logstash_handler = get_logstash_handler(config, database_path=database_path)
+    logger.addHandler(logstash_handler)
 
     return logger
 
@@ -319,7 +732,12 @@ def get_file_and_stdout_logger():
     return logger
 
 
-def get_log_metadata(custom_data, config, Env=None):
+def get_static_log_metadata(config, Env=None):
+    """
+    The part of the log metadata which does not change while the process runs.
+    Expensive because it starts external processes to gather facts so callers
+    handling many events should compute it once and pass it to `get_log_metadata`.
+    """
     hostname = platform.node().lower()
     location = hostname[1:5]
 
@@ -334,8 +752,8 @@ def get_log_metadata(custom_data, config, Env=None):
             # 'user_ui_language': locale.windows_locale[ windll.GetUserDefaultUILanguage() ],
             'user_name': os.getenv('username', default=os.getenv('USER')).lower(),
             'location_id': location,
-            'managed_network': config.getboolean('Environment', 'managed_network'),
-            'managed_software': config.getboolean('Environment', 'managed_software'),
+            'managed_network': get_config_value(config, 'Environment', 'managed_network'),
+            'managed_software': get_config_value(config, 'Environment', 'managed_software'),
             'custom': '',
         },
         'meta': {
@@ -351,7 +769,7 @@ def get_log_metadata(custom_data, config, Env=None):
            'distribution': str(Env.getOS()).capitalize(),
            'distribution_major_version': str(Env.getOSVersion()),
            'distribution_full_name': str(Env.getOS()).capitalize() + " " + Env.getOSVersion(),
-           'distribution_release_id': get_os_release_id(),
+           'distribution_release_id': get_os_release_id_cached(),
 
         })
     else:
@@ -360,28 +778,15 @@ def get_log_metadata(custom_data, config, Env=None):
            'distribution': str(platform.system()),
            'distribution_major_version': str(platform.release()),
            'distribution_full_name': platform.system() + " " + platform.release(),
-           'distribution_release_id': get_os_release_id(),
-           'virtual_machine': run_check_if_running_as_vm_imvirt(),
-        })
-
-    if 'uptime' in globals():
-        # Ref: ansible_uptime_seconds in Ansible facts
-        # We use "uptime" as field name because Kibana can make seconds human
-        # readable and that it looks odd if the field is called
-        # "uptime_seconds" but it is shown as a different unit.
-        extra['env'].update({
-           'uptime': int(uptime.uptime())
+           'distribution_release_id': get_os_release_id_cached(),
+           'virtual_machine': run_check_if_running_as_vm_imvirt_cached(),
         })
 
-    try:
-        extra['meta']['commit_hash'] = subprocess.Popen(
-         ["git", "rev-parse", "--short", "HEAD"],
-         stdout=subprocess.PIPE,
-        ).communicate()[0].strip()
-        # extra['meta']['uncommited_changes'] = git_working_copy_is_dirty()
-        # FIXME: Does not work
-    except OSError:
-        pass
+    commit_hash = get_git_commit_hash_cached()
+    if commit_hash is not None:
+        extra['meta']['commit_hash'] = commit_hash
+    # extra['meta']['uncommited_changes'] = git_working_copy_is_dirty()
+    # FIXME: Does not work
 
     # uncommited_changes means dirty working copy which means we are
     # developing which means -> staging
@@ -395,7 +800,30 @@ def get_log_metadata(custom_data, config, Env=None):
         extra['env']['location_id'] = config.get('Environment', 'location_id')
 
     if config.has_option('Meta', 'monitoring'):
-        extra['meta']['monitoring'] = config.getboolean('Meta', 'monitoring')
+        extra['meta']['monitoring'] = get_config_value(config, 'Meta', 'monitoring')
+
+    return extra
+
+
+def copy_nested_dicts(d):
+    """Copy `d` and all dicts below it. Other values are shared, `merge` only replaces them."""
+    return dict((k, copy_nested_dicts(v) if isinstance(v, dict) else v) for k, v in d.items())
+
+
+def get_log_metadata(custom_data, config, Env=None, static_log_metadata=None):
+    if static_log_metadata is None:
+        static_log_metadata = get_static_log_metadata(config, Env=Env)
+
+    extra = copy_nested_dicts(static_log_metadata)
+
+    if 'uptime' in globals():
+        # Ref: ansible_uptime_seconds in Ansible facts
+        # We use "uptime" as field name because Kibana can make seconds human
+        # readable and that it looks odd if the field is called
+        # "uptime_seconds" but it is shown as a different unit.
+        extra['env'].update({
+           'uptime': int(uptime.uptime())
+        })
 
     merge(extra, custom_data)
     return extra
@@ -405,11 +833,510 @@ def get_log_metadata(custom_data, config, Env=None):
 #     return pathlib.PureWindowsPath(path)
 
 
+def get_spool_journal_path():
+    """
+    Directory of the spool journal. Events are appended as one JSON document
+    per line to ``current.jsonl``. The drainer seals it by renaming it to
+    a timestamp named ``*.segment`` file which it then processes oldest first.
+    """
+    spool_journal_path = get_spool_path() + '/journal'
+    if not os.path.exists(spool_journal_path):
+        os.makedirs(spool_journal_path)
+
+    return spool_journal_path
+
+
+def get_spool_journal_active_file_path():
+    return get_spool_journal_path() + '/current.jsonl'
+
+
+def fsync_file(fh):
+    fh.flush()
+    try:
+        os.fsync(fh.fileno())
+    except (AttributeError, OSError):
+        # Not available under all Jython versions.
+        pass
+
+
+def write_file_atomically(file_path, content):
+    """
+    Write `content` (bytes or an iterable of bytes chunks) so that readers
+    either see the old or the new file, never a partial one.
+    """
+    tmp_file_path = '%s.%s.tmp' % (file_path, os.getpid())
+    tmp_fh = open(tmp_file_path, 'wb')
+    try:
+        if isinstance(content, bytes):
+            tmp_fh.write(content)
+        else:
+            for chunk in content:
+                tmp_fh.write(chunk)
+        fsync_file(tmp_fh)
+    finally:
+        tmp_fh.close()
+
+    if hasattr(os, 'replace'):
+        os.replace(tmp_file_path, file_path)
+    else:
+        # Python 2 on Windows can not rename onto an existing file.
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        os.rename(tmp_file_path, file_path)
+
+
+def read_json_file(file_path, default=None):
+    """Return the decoded content of `file_path` or `default` if it is missing or invalid."""
+    try:
+        json_fh = open(file_path, 'r')
+    except IOError:
+        return default
+
+    try:
+        return json.load(json_fh)
+    except ValueError:
+        return default
+    finally:
+        json_fh.close()
+
+
+def write_json_file_atomically(file_path, obj):
+    write_file_atomically(file_path, json.dumps(obj, sort_keys=True).encode('utf-8'))
+
+
+def append_to_spool_journal(spool_objs):
+    """
+    Append `spool_objs` to the spool journal as one batch.
+    The batch is durable once this function returns.
+    """
+    lines = ''.join(json.dumps(spool_obj) + '\n' for spool_obj in spool_objs)
+
+    journal_fh = open(get_spool_journal_active_file_path(), 'ab')
+    try:
+        journal_fh.write(lines.encode('utf-8'))
+        fsync_file(journal_fh)
+    finally:
+        journal_fh.close()
+
+
+def seal_spool_journal():
+    """Turn the active journal file into a segment so that the drainer has exclusive access to it."""
+    active_file_path = get_spool_journal_active_file_path()
+    if not os.path.exists(active_file_path):
+        return None
+
+    segment_file_path = get_spool_journal_path() + '/' + get_filename_save_cur_timestamp() + '.segment'
+    try:
+        os.rename(active_file_path, segment_file_path)
+    except OSError:
+        # On Windows, a writer might have the file open right now.
+        # The events are picked up by the next drain.
+        return None
+
+    return segment_file_path
+
+
+def read_spool_journal_segment_offset(segment_file_path):
+    try:
+        offset_fh = open(segment_file_path + '.offset', 'r')
+    except IOError:
+        return 0
+
+    try:
+        return int(offset_fh.read().strip() or 0)
+    except ValueError:
+        return 0
+    finally:
+        offset_fh.close()
+
+
+def commit_spool_journal_segment_offset(segment_file_path, offset):
+    write_file_atomically(segment_file_path + '.offset', str(offset).encode('ascii'))
+
+
+def list_dir_file_names(dir_path, suffix):
+    """
+    Sorted names of the files in `dir_path` ending with `suffix`.
+    Uses os.scandir where available, it does not need a stat call per entry on Windows.
+    """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        return sorted(f for f in os.listdir(dir_path) if f.endswith(suffix))
+
+    return sorted(e.name for e in scandir(dir_path) if e.name.endswith(suffix) and e.is_file())
+
+
+# Timestamp named as written by `get_filename_save_cur_timestamp` in Python and AutoIt.
+LEGACY_SPOOL_FILE_NAME_REGEX = re.compile(r'^\d{4}-\d{2}-\d{2}.*\.json$')
+
+
+def get_legacy_spool_file_names(spool_path):
+    """
+    Sorted names of the one file per event spool files in `spool_path`.
+    State files like events_shipping_state.json and evictions.json are kept in the same directory.
+    """
+    return [f for f in list_dir_file_names(spool_path, '.json') if LEGACY_SPOOL_FILE_NAME_REGEX.match(f)]
+
+
+def get_spool_journal_segment_file_paths():
+    spool_journal_path = get_spool_journal_path()
+    return [spool_journal_path + '/' + f for f in list_dir_file_names(spool_journal_path, '.segment')]
+
+
+def parse_spool_journal_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        print("Skipping invalid event: " + line[:100])
+        return None
+
+
+def drain_spool_journal_batches(batch_size=100):
+    """
+    Yield the journaled events as lists of at most `batch_size` raw JSON lines, oldest first.
+
+    The read position of a segment is committed when the consumer asks for
+    the next batch, so at most one batch is delivered again after a crash.
+    Fully drained segments are deleted.
+    """
+    seal_spool_journal()
+
+    for segment_file_path in get_spool_journal_segment_file_paths():
+        offset = read_spool_journal_segment_offset(segment_file_path)
+        segment_fh = open(segment_file_path, 'rb')
+        try:
+            segment_fh.seek(offset)
+            batch = []
+            for line in iter(segment_fh.readline, b''):
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash. Nothing can follow it.
+                    print("Skipping incomplete event at the end of: " + segment_file_path)
+                    break
+
+                batch.append(line.decode('utf-8'))
+                offset += len(line)
+                if len(batch) >= batch_size:
+                    yield batch
+                    commit_spool_journal_segment_offset(segment_file_path, offset)
+                    batch = []
+
+            if batch:
+                yield batch
+        finally:
+            segment_fh.close()
+
+        os.remove(segment_file_path)
+        if os.path.exists(segment_file_path + '.offset'):
+            os.remove(segment_file_path + '.offset')
+
+
+# Levels which are evicted first when the spool exceeds its limits.
+SPOOL_EVICTABLE_LEVELS = ('debug', 'info')
+
+
+def get_spool_evictions_file_path():
+    return get_spool_path() + '/evictions.json'
+
+
+def record_spool_evictions(evicted_counts_by_level):
+    evictions = read_json_file(get_spool_evictions_file_path(), {})
+    for level, count in evicted_counts_by_level.items():
+        evictions[level] = evictions.get(level, 0) + count
+    write_json_file_atomically(get_spool_evictions_file_path(), evictions)
+
+
+def plan_spool_eviction(entries, max_bytes=0, max_events=0):
+    """
+    Decide what to drop so that the spool fits into `max_bytes` and `max_events` (0 means no limit).
+
+    `entries` are `(level, size, stripped_size, event_count)` tuples, oldest
+    first. `stripped_size` is the size without the full exception texts or
+    None if there are none. Entries of multiple events (outgoing segments)
+    have no level and can only be evicted as a whole.
+    First the oldest info/debug events are evicted, then the full exception
+    texts of the remaining events are dropped (`exception_short` is kept),
+    then the oldest remaining entries are evicted.
+    Returns the sets of indexes to evict and to strip.
+    """
+    totals = {
+        'bytes': sum(entry[1] for entry in entries),
+        'events': sum(entry[3] for entry in entries),
+    }
+
+    def over_limit():
+        return (max_bytes and totals['bytes'] > max_bytes) or (max_events and totals['events'] > max_events)
+
+    evict = set()
+    strip = set()
+
+    for index, (level, size, stripped_size, event_count) in enumerate(entries):
+        if not over_limit():
+            break
+        if level in SPOOL_EVICTABLE_LEVELS:
+            evict.add(index)
+            totals['bytes'] -= size
+            totals['events'] -= event_count
+
+    for index, (level, size, stripped_size, event_count) in enumerate(entries):
+        if not over_limit():
+            break
+        if index not in evict and stripped_size is not None:
+            strip.add(index)
+            totals['bytes'] -= size - stripped_size
+
+    for index, (level, size, stripped_size, event_count) in enumerate(entries):
+        if not over_limit():
+            break
+        if index not in evict:
+            evict.add(index)
+            strip.discard(index)
+            totals['bytes'] -= size if stripped_size is None else stripped_size
+            totals['events'] -= event_count
+
+    return evict, strip
+
+
+def strip_exception_details(obj):
+    """Drop the full exception texts of an event, `exception_short` is kept. Returns False if there were none."""
+    if obj.get('exception'):
+        obj['exception'] = []
+        return True
+    return False
+
+
+def get_event_level(event):
+    return str(event.get('level', 'info')).lower()
+
+
+def get_outgoing_events_segment_file_paths():
+    """Segments of the incremental scp mode which were not sent yet, oldest first."""
+    outgoing_path = get_events_segment_outgoing_path()
+    segment_file_paths = [outgoing_path + '/' + f for f in list_dir_file_names(outgoing_path, '.events.gz')]
+    # Segments of an older generation can have higher event IDs, so the modification time comes first.
+    return sorted(
+        (f for f in segment_file_paths if parse_events_segment_file_name(f)),
+        key=lambda f: (os.path.getmtime(f), parse_events_segment_file_name(f)['first_event_id']))
+
+
+def get_events_segment_event_count(segment_file_path):
+    """Upper bound from the event ID range in the name, rows might have been evicted from events.db before the export."""
+    segment = parse_events_segment_file_name(segment_file_path)
+    return segment['last_event_id'] - segment['first_event_id'] + 1
+
+
+def get_spool_usage(events_db_path):
+    """Return the number of spooled events and their size in bytes, without parsing them."""
+    event_count = 0
+    byte_count = 0
+
+    for segment_file_path in get_outgoing_events_segment_file_paths():
+        event_count += get_events_segment_event_count(segment_file_path)
+        byte_count += os.path.getsize(segment_file_path)
+
+    for segment_file_path in get_spool_journal_segment_file_paths():
+        segment_fh = open(segment_file_path, 'rb')
+        try:
+            segment_fh.seek(read_spool_journal_segment_offset(segment_file_path))
+            for chunk in iter(lambda: segment_fh.read(1024 * 1024), b''):
+                event_count += chunk.count(b'\n')
+                byte_count += len(chunk)
+        finally:
+            segment_fh.close()
+
+    if os.path.exists(events_db_path):
+        import sqlite3
+
+        connection = sqlite3.connect(events_db_path)
+        try:
+            db_event_count, db_byte_count = connection.execute(
+                'SELECT COUNT(*), SUM(LENGTH(event_text)) FROM event').fetchone()
+        except sqlite3.OperationalError:
+            # No table yet.
+            db_event_count, db_byte_count = 0, 0
+        finally:
+            connection.close()
+        event_count += db_event_count
+        byte_count += db_byte_count or 0
+
+    return event_count, byte_count
+
+
+def get_spool_eviction_entries(events_db_path):
+    """
+    First pass of `enforce_spool_limits` over all spooled events, oldest
+    first: The outgoing segments of the incremental scp mode, the
+    logstash_async events.db which the journal is drained into, then the
+    journal segments.
+
+    Returns `(locations, entries)`. `entries` are the tuples for
+    `plan_spool_eviction`. `locations` holds where each entry is stored as
+    `(store, key)`: `('outgoing', segment_file_path)`,
+    `('events_db', event_id)` or `(segment_file_path, line_number)` with
+    the line number counted from the committed offset.
+    The event texts are not kept because this runs when the spool is
+    larger than it should be, possibly larger than the available memory.
+    """
+    locations = []
+    entries = []
+
+    for segment_file_path in get_outgoing_events_segment_file_paths():
+        locations.append(('outgoing', segment_file_path))
+        entries.append((None, os.path.getsize(segment_file_path), None, get_events_segment_event_count(segment_file_path)))
+
+    if os.path.exists(events_db_path):
+        for event_id, event_text in read_events_db(events_db_path):
+            level = 'info'
+            stripped_size = None
+            try:
+                event = json.loads(event_text)
+                level = get_event_level(event)
+                if strip_exception_details(event):
+                    stripped_size = len(json.dumps(event))
+            except ValueError:
+                pass
+            locations.append(('events_db', event_id))
+            entries.append((level, len(event_text), stripped_size, 1))
+
+    for segment_file_path in get_spool_journal_segment_file_paths():
+        segment_fh = open(segment_file_path, 'rb')
+        try:
+            segment_fh.seek(read_spool_journal_segment_offset(segment_file_path))
+            for line_number, line in enumerate(iter(segment_fh.readline, b'')):
+                level = 'info'
+                stripped_size = None
+                try:
+                    spool_obj = json.loads(line.decode('utf-8'))
+                    level = get_event_level(spool_obj)
+                    if strip_exception_details(spool_obj.get('extra', {})):
+                        stripped_size = len((json.dumps(spool_obj) + '\n').encode('utf-8'))
+                except ValueError:
+                    pass
+                locations.append((segment_file_path, line_number))
+                entries.append((level, len(line), stripped_size, 1))
+        finally:
+            segment_fh.close()
+
+    return locations, entries
+
+
+def count_events_segment_levels(segment_file_path, counts_by_level):
+    """Add the number of events per level in the outgoing segment to `counts_by_level`."""
+    event_count = get_events_segment_event_count(segment_file_path)
+    try:
+        for event_id, event_text in read_events_segment(segment_file_path):
+            level = 'info'
+            try:
+                level = get_event_level(json.loads(event_text))
+            except ValueError:
+                pass
+            counts_by_level[level] = counts_by_level.get(level, 0) + 1
+            event_count -= 1
+    except (IOError, EOFError, ValueError):
+        # Corrupt segment, the rest is counted with the default level.
+        counts_by_level['info'] = counts_by_level.get('info', 0) + max(event_count, 0)
+
+
+def rewrite_spool_journal_segment(segment_file_path, evict_line_numbers, strip_line_numbers):
+    """
+    Rewrite the part of the journal segment after the committed offset
+    without the evicted lines and with the full exception texts of the
+    stripped ones dropped. Streams so that only one line is in memory.
+    """
+    def get_lines():
+        segment_fh = open(segment_file_path, 'rb')
+        try:
+            segment_fh.seek(read_spool_journal_segment_offset(segment_file_path))
+            for line_number, line in enumerate(iter(segment_fh.readline, b'')):
+                if line_number in evict_line_numbers:
+                    continue
+                if line_number in strip_line_numbers:
+                    spool_obj = json.loads(line.decode('utf-8'))
+                    strip_exception_details(spool_obj.get('extra', {}))
+                    line = (json.dumps(spool_obj) + '\n').encode('utf-8')
+                yield line
+        finally:
+            segment_fh.close()
+
+    write_file_atomically(segment_file_path, get_lines())
+    # The lines before the committed offset are gone, so the offset starts over.
+    if os.path.exists(segment_file_path + '.offset'):
+        os.remove(segment_file_path + '.offset')
+
+
+def enforce_spool_limits(config, events_db_path=None):
+    """
+    Keep the spool below `spool_max_megabytes` and `spool_max_events` from the
+    Output section by evicting events as described in `plan_spool_eviction`.
+    The number of evicted events per level is recorded in evictions.json and
+    reported with the next shipped event.
+    Needs to run while nothing else uses events.db.
+    """
+    if events_db_path is None:
+        events_db_path = get_spool_path() + '/events.db'
+
+    max_bytes = int(get_config_option(config, 'Output', 'spool_max_megabytes', 1024) * 1024 * 1024)
+    max_events = get_config_option(config, 'Output', 'spool_max_events', 200000)
+
+    seal_spool_journal()
+    event_count, byte_count = get_spool_usage(events_db_path)
+    if not ((max_bytes and byte_count > max_bytes) or (max_events and event_count > max_events)):
+        return {}
+
+    locations, entries = get_spool_eviction_entries(events_db_path)
+    evict, strip = plan_spool_eviction(entries, max_bytes=max_bytes, max_events=max_events)
+
+    evicted_counts_by_level = {}
+    evicted_event_ids = []
+    stripped_event_ids = []
+    journal_changes = {}
+    for index in sorted(evict | strip):
+        store, key = locations[index]
+        if store == 'outgoing':
+            count_events_segment_levels(key, evicted_counts_by_level)
+            os.remove(key)
+            continue
+
+        if index in evict:
+            level = entries[index][0]
+            evicted_counts_by_level[level] = evicted_counts_by_level.get(level, 0) + 1
+
+        if store == 'events_db':
+            (evicted_event_ids if index in evict else stripped_event_ids).append(key)
+        else:
+            evict_line_numbers, strip_line_numbers = journal_changes.setdefault(store, (set(), set()))
+            (evict_line_numbers if index in evict else strip_line_numbers).add(key)
+
+    if evicted_event_ids or stripped_event_ids:
+        import sqlite3
+
+        connection = sqlite3.connect(events_db_path)
+        try:
+            connection.executemany('DELETE FROM event WHERE event_id = ?', [(event_id,) for event_id in evicted_event_ids])
+            for event_id in stripped_event_ids:
+                event_text = connection.execute('SELECT event_text FROM event WHERE event_id = ?', (event_id,)).fetchone()[0]
+                event = json.loads(event_text)
+                strip_exception_details(event)
+                connection.execute('UPDATE event SET event_text = ? WHERE event_id = ?', (json.dumps(event), event_id))
+            connection.commit()
+        finally:
+            connection.close()
+
+    for segment_file_path, (evict_line_numbers, strip_line_numbers) in journal_changes.items():
+        rewrite_spool_journal_segment(segment_file_path, evict_line_numbers, strip_line_numbers)
+
+    record_spool_evictions(evicted_counts_by_level)
+    print("Spool limits exceeded, evicted %d and stripped %d entries." % (len(evict), len(strip)))
+
+    return evicted_counts_by_level
+
+
 def store_log_event(level, msg, extra=None):
     if not extra:
         extra = {}
 
     extra.setdefault('meta', {})['test'] = get_script_name()
+    # Stable across all retries between the probe and Elasticsearch. Used to drop duplicates.
+    extra['meta'].setdefault('event_id', str(uuid.uuid4()))
 
     spool_obj = {
         'level': level,
@@ -417,11 +1344,7 @@ def store_log_event(level, msg, extra=None):
         'extra': extra,
     }
 
-    spool_file = get_spool_path() + '/' + get_filename_save_cur_timestamp() + '.json'
-    spool_fh = open(spool_file, 'w')
-    # with open(spool_file, 'w') as spool_fh:
-    json.dump(spool_obj, spool_fh)
-    spool_fh.close()
+    append_to_spool_journal([spool_obj])
 
 
 def get_log_structured_data(log_structured_data=None):
@@ -437,9 +1360,47 @@ def get_log_structured_data(log_structured_data=None):
     return log_structured_data
 
 
-def process_log_events():
+def get_config_option(config, section, option, default):
+    """Typed value of an optional option, refer to `get_config_value`."""
+    if not config.has_option(section, option):
+        return default
+
+    return get_config_value(config, section, option)
+
+
+def process_log_events(catch_up=False, print_events=None):
+    """
+    Send all spooled events to Logstash. Every event is printed if
+    `print_events`, which defaults to not `catch_up`.
+
+    With `catch_up`, the journal is processed in larger batches, delivery is
+    rate limited and a summary with the throughput is printed at the end
+    instead of every event. Intended for draining a large backlog. The rate
+    limit applies to the connection with `logstash_output_mode=batched`,
+    else to the handover to logstash_async which sends on its own.
+    """
     config = get_config()
-    logger = get_logger(config)
+    if print_events is None:
+        print_events = not catch_up
+
+    # Before logstash_async opens events.db.
+    enforce_spool_limits(config)
+    spool_evictions = read_json_file(get_spool_evictions_file_path())
+
+    if catch_up:
+        batch_size = get_config_option(config, 'Output', 'catch_up_batch_size', 500)
+        max_events_per_second = get_config_option(config, 'Output', 'catch_up_max_events_per_second', 0.0)
+    else:
+        batch_size = 100
+        max_events_per_second = 0
+
+    logstash_handler = get_logstash_handler(config, max_events_per_second=max_events_per_second)
+    logger = get_logger(config, logstash_handler=logstash_handler)
+    if isinstance(logstash_handler, BatchingLogstashHandler):
+        # Limited by the sender.
+        handover_max_events_per_second = 0
+    else:
+        handover_max_events_per_second = max_events_per_second
 
     log_function_map = {
         'critical': logger.critical,
@@ -450,22 +1411,115 @@ def process_log_events():
         'debug': logger.debug,
     }
 
-    for spool_file in glob.glob(get_spool_path() + '/*.json'):
-        #  print(spool_file)
-        spool_fh = open(spool_file, 'r')
-        # with open(spool_file, 'r') as spool_fh:
-        try:
-            spool_obj = json.load(spool_fh)
-            spool_obj['extra'] = get_log_metadata(spool_obj['extra'], config)
+    # Computed on the first event so that an empty spool does not start any processes.
+    static_log_metadata = []
+
+    def ensure_static_log_metadata():
+        if not static_log_metadata:
+            static_log_metadata.append(get_static_log_metadata(config))
+
+    def enrich_spool_obj(spool_obj):
+        if spool_obj is not None:
+            spool_obj['extra'] = get_log_metadata(spool_obj['extra'], config, static_log_metadata=static_log_metadata[0])
+        return spool_obj
+
+    def parse_and_enrich_spool_journal_line(line):
+        return enrich_spool_obj(parse_spool_journal_line(line))
+
+    start_time = time.time()
+    event_count = [0]
+    # Events of batches which were sent or stored and committed. The
+    # remaining ones of an interrupted batch stay in the spool.
+    committed_event_count = 0
+
+    def emit_spool_obj(spool_obj):
+        if event_count[0] == 0 and spool_evictions:
+            # Make data loss visible.
+            spool_obj['extra'].setdefault('meta', {})['spool_evicted_events'] = spool_evictions
+
+        if print_events:
             print(spool_obj)
-            log_function_map[spool_obj['level']](
-                spool_obj['msg'],
-                extra=spool_obj['extra'],
-            )
-        except ValueError:
-            print("Deleting invalid file: " + spool_file)
-        spool_fh.close()
-        os.unlink(spool_file)
+        log_function_map[spool_obj['level']](
+            spool_obj['msg'],
+            extra=spool_obj['extra'],
+        )
+        event_count[0] += 1
+
+        if handover_max_events_per_second > 0:
+            ahead_seconds = event_count[0] / handover_max_events_per_second - (time.time() - start_time)
+            if ahead_seconds > 0:
+                time.sleep(ahead_seconds)
+
+    def remove_reported_spool_evictions():
+        # Only once the first event which reports them is committed, else they would be lost on a failure.
+        if spool_evictions and event_count[0] > 0 and os.path.exists(get_spool_evictions_file_path()):
+            os.remove(get_spool_evictions_file_path())
+
+    # One spool file per event was used before the spool journal.
+    # Drain what is left from that.
+    spool_path = get_spool_path()
+    legacy_spool_file_names = get_legacy_spool_file_names(spool_path)
+    queue_full = False
+    for offset in range(0, len(legacy_spool_file_names), batch_size):
+        spool_files = [spool_path + '/' + f for f in legacy_spool_file_names[offset:offset + batch_size]]
+        try:
+            for spool_file in spool_files:
+                #  print(spool_file)
+                spool_fh = open(spool_file, 'r')
+                # with open(spool_file, 'r') as spool_fh:
+                try:
+                    spool_obj = json.load(spool_fh)
+                    ensure_static_log_metadata()
+                    emit_spool_obj(enrich_spool_obj(spool_obj))
+                except ValueError:
+                    print("Deleting invalid file: " + spool_file)
+                spool_fh.close()
+
+            # The files are the only copy of the events so they are kept until the events are sent.
+            if isinstance(logstash_handler, BatchingLogstashHandler):
+                logstash_handler.ensure_flushed()
+        except LogstashQueueFullError as err:
+            print("%s Leaving the remaining events in the spool." % err)
+            queue_full = True
+            break
+
+        for spool_file in spool_files:
+            os.unlink(spool_file)
+        committed_event_count = event_count[0]
+        remove_reported_spool_evictions()
+
+    # Keep the order, the journal only holds events newer than the legacy files.
+    journal_batches = [] if queue_full else drain_spool_journal_batches(batch_size)
+    for batch in journal_batches:
+        ensure_static_log_metadata()
+        try:
+            for line in batch:
+                spool_obj = parse_and_enrich_spool_journal_line(line)
+                if spool_obj is not None:
+                    emit_spool_obj(spool_obj)
+
+            # The batch is committed when the next one is requested so it needs to be sent by then.
+            if isinstance(logstash_handler, BatchingLogstashHandler):
+                logstash_handler.ensure_flushed()
+        except LogstashQueueFullError as err:
+            print("%s Leaving the remaining events in the spool." % err)
+            break
+
+        committed_event_count = event_count[0]
+        remove_reported_spool_evictions()
+        if catch_up:
+            print("Processed %d events, %.1f events/s." % (
+                committed_event_count, committed_event_count / max(time.time() - start_time, 0.001)))
+
+    if catch_up:
+        duration = time.time() - start_time
+        print("Catch-up done: %d events in %.1f s, %.1f events/s." % (
+            committed_event_count, duration, committed_event_count / max(duration, 0.001)))
+
+    # Have everything in events.db or sent before returning so that
+    # `scp_log_events` can run in the same process.
+    logger.removeHandler(logstash_handler)
+    logstash_handler.close()
 
 
 def get_scp_target_dir_path():
@@ -478,11 +1532,390 @@ def get_scp_target_dir_path():
     )
 
 
+# Incremental shipping of events.db for `logstash_via_scp_incremental`.
+# Rows which were not shipped yet are exported into gzip compressed segment
+# files named `<hostname>_<generation>_<first_event_id>-<last_event_id>_<sha256>.events.gz`.
+# The generation changes when events.db is recreated because event IDs start
+# over then. The collector uses the name to verify and deduplicate segments.
+
+EVENTS_SEGMENT_FILE_NAME_REGEX = re.compile(
+    r'^(?P<hostname>.+)_(?P<generation>[0-9a-f]+)_(?P<first_event_id>\d+)-(?P<last_event_id>\d+)_(?P<sha256>[0-9a-f]{64})\.events\.gz$')
+
+
+def get_events_segment_outgoing_path():
+    outgoing_path = get_spool_path() + '/outgoing'
+    if not os.path.exists(outgoing_path):
+        os.makedirs(outgoing_path)
+
+    return outgoing_path
+
+
+def get_events_shipping_state_file_path():
+    return get_spool_path() + '/events_shipping_state.json'
+
+
+def parse_events_segment_file_name(file_name):
+    """Return a dict with the fields of the segment file name or None if it is not a segment."""
+    match = EVENTS_SEGMENT_FILE_NAME_REGEX.match(os.path.basename(file_name))
+    if not match:
+        return None
+
+    segment = match.groupdict()
+    segment['first_event_id'] = int(segment['first_event_id'])
+    segment['last_event_id'] = int(segment['last_event_id'])
+    return segment
+
+
+def get_file_sha256(file_path):
+    import hashlib
+
+    sha256 = hashlib.sha256()
+    file_fh = open(file_path, 'rb')
+    try:
+        for chunk in iter(lambda: file_fh.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    finally:
+        file_fh.close()
+
+    return sha256.hexdigest()
+
+
+def verify_events_segment(segment_file_path):
+    segment = parse_events_segment_file_name(segment_file_path)
+    return segment is not None and segment['sha256'] == get_file_sha256(segment_file_path)
+
+
+def read_events_segment(segment_file_path):
+    """Yield `(event_id, event_text)` for all events in the segment."""
+    import gzip
+
+    segment_fh = gzip.open(segment_file_path, 'rb')
+    try:
+        for line in segment_fh:
+            row = json.loads(line.decode('utf-8'))
+            yield row['event_id'], row['event_text']
+    finally:
+        segment_fh.close()
+
+
+def read_events_db(database_path, after_event_id=0):
+    """Yield `(event_id, event_text)` for the events in a logstash_async events database with an ID above `after_event_id`."""
+    import sqlite3
+
+    connection = sqlite3.connect(database_path)
+    try:
+        rows = connection.execute(
+            'SELECT event_id, event_text FROM event WHERE event_id > ? ORDER BY event_id',
+            (after_event_id,))
+        for row in rows:
+            yield row[0], row[1]
+    finally:
+        connection.close()
+
+
+def get_event_id_from_event_text(event_text):
+    """
+    `meta.event_id` as set by `store_log_event`. Events from before it was
+    introduced are identified by a hash of their text, which does not change
+    while the event is retried.
+    """
+    try:
+        event_id = json.loads(event_text).get('meta', {}).get('event_id')
+    except (ValueError, AttributeError):
+        event_id = None
+
+    if event_id is None:
+        import hashlib
+
+        if not isinstance(event_text, bytes):
+            event_text = event_text.encode('utf-8')
+        event_id = 'sha1:' + hashlib.sha1(event_text).hexdigest()
+
+    return event_id
+
+
+class TimeWindowedSeenSet(object):
+    """
+    Remembers event IDs for at least `window_seconds` in fixed memory.
+
+    Two Bloom filters are used as generations. New IDs go into the current
+    one, lookups check both. The current generation becomes the previous one
+    after `window_seconds` or when it holds `capacity` IDs, the old previous
+    one is dropped. `false_positive_rate` is the approximate rate of lookups
+    with both generations full, so each generation is sized for half of it.
+    Memory is about 2 * `capacity` * 31 bits for the default rate. A false
+    positive drops an event which was not a duplicate, so keep
+    `false_positive_rate` low.
+    """
+
+    def __init__(self, capacity=1000000, window_seconds=7 * 24 * 3600, false_positive_rate=1e-6):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        generation_false_positive_rate = false_positive_rate / 2.0
+        self.bit_count = int(math.ceil(-capacity * math.log(generation_false_positive_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / float(capacity) * math.log(2))))
+        self._generations = [self._new_generation(), self._new_generation()]
+        self._lock = threading.Lock()
+
+    def _new_generation(self):
+        return {
+            'start_time': time.time(),
+            'count': 0,
+            'bits': bytearray((self.bit_count + 7) // 8),
+        }
+
+    def _get_bit_positions(self, event_id):
+        import hashlib
+
+        if not isinstance(event_id, bytes):
+            event_id = event_id.encode('utf-8')
+        digest = hashlib.sha1(event_id).digest()
+        h1 = struct.unpack('>Q', digest[:8])[0]
+        h2 = struct.unpack('>Q', digest[8:16])[0] | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    @staticmethod
+    def _contains_positions(generation, positions):
+        bits = generation['bits']
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def contains(self, event_id):
+        positions = self._get_bit_positions(event_id)
+        with self._lock:
+            return any(self._contains_positions(g, positions) for g in self._generations)
+
+    def add(self, event_id):
+        positions = self._get_bit_positions(event_id)
+        with self._lock:
+            current = self._generations[0]
+            if current['count'] >= self.capacity or time.time() - current['start_time'] >= self.window_seconds:
+                self._generations = [self._new_generation(), current]
+                current = self._generations[0]
+
+            for position in positions:
+                current['bits'][position >> 3] |= 1 << (position & 7)
+            current['count'] += 1
+
+    def save(self, file_path):
+        with self._lock:
+            header = {
+                'bit_count': self.bit_count,
+                'hash_count': self.hash_count,
+                'generations': [{'start_time': g['start_time'], 'count': g['count']} for g in self._generations],
+            }
+            content = json.dumps(header).encode('utf-8') + b'\n' + b''.join(bytes(g['bits']) for g in self._generations)
+        write_file_atomically(file_path, content)
+
+    def load(self, file_path):
+        """Restore a previously saved state. Ignored if missing or saved with different parameters."""
+        try:
+            state_fh = open(file_path, 'rb')
+        except IOError:
+            return False
+
+        try:
+            header = json.loads(state_fh.readline().decode('utf-8'))
+            if header['bit_count'] != self.bit_count or header['hash_count'] != self.hash_count:
+                return False
+
+            generations = []
+            for generation_header in header['generations']:
+                bits = bytearray(state_fh.read((self.bit_count + 7) // 8))
+                if len(bits) != (self.bit_count + 7) // 8:
+                    return False
+                generations.append({
+                    'start_time': generation_header['start_time'],
+                    'count': generation_header['count'],
+                    'bits': bits,
+                })
+        except (ValueError, KeyError):
+            return False
+        finally:
+            state_fh.close()
+
+        with self._lock:
+            self._generations = generations
+        return True
+
+
+def export_events_db_segment(events_db_path, hostname=None):
+    """
+    Export all rows of the logstash_async `events_db_path` which have not been
+    exported before into a new segment file in the outgoing directory and
+    remove them from the database. Returns the path of the segment or None.
+    """
+    import gzip
+    import sqlite3
+
+    if hostname is None:
+        hostname = platform.node().lower()
+
+    outgoing_path = get_events_segment_outgoing_path()
+    state = read_json_file(get_events_shipping_state_file_path(), {})
+
+    connection = sqlite3.connect(events_db_path)
+    try:
+        # The generation is stored in events.db itself. When the file is
+        # recreated, event IDs start over and it gets a new generation, even
+        # if its IDs already went past the last exported one.
+        connection.execute('CREATE TABLE IF NOT EXISTS e2e_meta (generation TEXT)')
+        generation_row = connection.execute('SELECT generation FROM e2e_meta').fetchone()
+        if generation_row is None:
+            generation = uuid.uuid4().hex[:8]
+            connection.execute('INSERT INTO e2e_meta (generation) VALUES (?)', (generation,))
+            connection.commit()
+        else:
+            generation = generation_row[0]
+
+        last_exported_event_id = 0
+        if state.get('generation') == generation:
+            last_exported_event_id = state.get('last_exported_event_id', 0)
+
+        # The segment is written before the state. If we crashed in between,
+        # the segment in the outgoing directory is the authority.
+        for segment_file_name in list_dir_file_names(outgoing_path, '.events.gz'):
+            segment = parse_events_segment_file_name(segment_file_name)
+            if segment and segment['generation'] == generation:
+                last_exported_event_id = max(last_exported_event_id, segment['last_event_id'])
+
+        rows = connection.execute(
+            'SELECT event_id, event_text FROM event WHERE event_id > ? ORDER BY event_id',
+            (last_exported_event_id,))
+
+        tmp_file_path = outgoing_path + '/export.tmp'
+        tmp_fh = gzip.open(tmp_file_path, 'wb')
+        first_event_id = None
+        last_event_id = None
+        try:
+            for event_id, event_text in rows:
+                if first_event_id is None:
+                    first_event_id = event_id
+                last_event_id = event_id
+                if isinstance(event_text, bytes):
+                    # Rows written as BLOB, for example by Python 2, come back as bytes.
+                    event_text = event_text.decode('utf-8')
+                tmp_fh.write((json.dumps({'event_id': event_id, 'event_text': event_text}) + '\n').encode('utf-8'))
+        finally:
+            tmp_fh.close()
+
+        segment_file_path = None
+        if first_event_id is None:
+            os.remove(tmp_file_path)
+        else:
+            segment_file_path = '%s/%s_%s_%012d-%012d_%s.events.gz' % (
+                outgoing_path, hostname, generation, first_event_id, last_event_id,
+                get_file_sha256(tmp_file_path))
+            os.rename(tmp_file_path, segment_file_path)
+            last_exported_event_id = last_event_id
+
+        write_json_file_atomically(get_events_shipping_state_file_path(), {
+            'generation': generation,
+            'last_exported_event_id': last_exported_event_id,
+        })
+
+        connection.execute('DELETE FROM event WHERE event_id <= ?', (last_exported_event_id,))
+        connection.commit()
+    finally:
+        connection.close()
+
+    return segment_file_path
+
+
+def quote_remote_shell_path(path):
+    """Double quote `path` for a POSIX shell but keep a leading `~/` unquoted so that the shell expands it."""
+    if path.startswith('~/'):
+        return '~/"%s"' % path[2:]
+    return '"%s"' % path
+
+
+def get_remote_rename_command(target_file_path):
+    """Shell command run on the target to move the uploaded `.part` file into place."""
+    return 'mv %s %s' % (
+        quote_remote_shell_path(target_file_path + '.part'),
+        quote_remote_shell_path(target_file_path),
+    )
+
+
+def send_events_segment_via_scp(config, segment_file_path):
+    """
+    Upload under a temporary name and rename on the target so that the
+    collector never picks up a partial segment.
+    """
+    user_host = '%s@%s' % (
+        config.get('Output', 'logstash_via_scp_user'),
+        config.get('Output', 'logstash_via_scp_host'),
+    )
+    target_file_path = '%s/%s' % (
+        config.get('Output', 'logstash_via_scp_path'),
+        os.path.basename(segment_file_path),
+    )
+
+    # Getting the return code of `scp` through `git-bash.exe` does not work, doing `rm` in bash.
+    subprocess.call([
+       '/Program Files/Git/git-bash.exe',
+       '-c', 'scp "%s" "%s:%s.part" && ssh "%s" \'%s\' && rm "%s"' % (
+           segment_file_path, user_host, target_file_path,
+           user_host, get_remote_rename_command(target_file_path),
+           segment_file_path),
+    ], stdout=subprocess.PIPE)
+
+    return not os.path.exists(segment_file_path)
+
+
+def send_events_segment_via_directory_copy(config, segment_file_path):
+    """Copy to `logstash_via_scp_path` as local directory. Useful for network shares and for testing."""
+    import shutil
+
+    target_dir_path = os.path.expanduser(config.get('Output', 'logstash_via_scp_path'))
+    if not os.path.exists(target_dir_path):
+        os.makedirs(target_dir_path)
+
+    target_file_path = target_dir_path + '/' + os.path.basename(segment_file_path)
+    shutil.copyfile(segment_file_path, target_file_path + '.part')
+    if os.path.exists(target_file_path):
+        os.remove(target_file_path)
+    os.rename(target_file_path + '.part', target_file_path)
+
+    os.remove(segment_file_path)
+    return True
+
+
+EVENTS_SEGMENT_TRANSPORTS = {
+    'scp': send_events_segment_via_scp,
+    'directory': send_events_segment_via_directory_copy,
+}
+
+
+def ship_events_segments(config):
+    """Send all outgoing segments, oldest first. Stops at the first failure to keep the order."""
+    transport_name = get_config_option(config, 'Output', 'logstash_via_scp_transport', 'scp')
+    send_events_segment = EVENTS_SEGMENT_TRANSPORTS[transport_name]
+
+    for segment_file_path in get_outgoing_events_segment_file_paths():
+        if not send_events_segment(config, segment_file_path):
+            print("Failed to ship " + os.path.basename(segment_file_path) + ", retrying on the next run.")
+            return False
+
+    return True
+
+
 def scp_log_events():
     config = get_config()
     source_file = get_spool_path() + '/events.db'
 
-    if config.getboolean('Output', 'logstash_via_scp') and os.path.exists(source_file):
+    if not get_config_value(config, 'Output', 'logstash_via_scp'):
+        return
+
+    if get_config_option(config, 'Output', 'logstash_via_scp_incremental', False):
+        if os.path.exists(source_file):
+            export_events_db_segment(source_file)
+        ship_events_segments(config)
+        return
+
+    if os.path.exists(source_file):
         hostname = platform.node().lower()
         timestamp = get_filename_save_cur_timestamp()
         target_filename = '%s_%s_events.db' % (hostname, timestamp)
@@ -500,7 +1933,7 @@ def scp_log_events():
         ], stdout=subprocess.PIPE)
 
 
-def get_config():
+def load_config(config_file_path):
     config_file = ConfigParser(defaults={
         'syslog': 'False',
         'csv': 'False',
@@ -508,11 +1941,141 @@ def get_config():
         'managed_network': 'True',
         'managed_software': 'True',
     })
-    config_file.read(get_config_file_path())
+    config_file.read(config_file_path)
 
     return config_file
 
 
+# Process-wide configuration, refer to `get_config`.
+config_cache = {}
+
+# Getters of the options which are not strings by section and option. A
+# getter is the name of a ConfigParser method or a function which parses
+# the string value. Options of other sections are looked up in
+# `TEST_CONFIG_OPTION_GETTERS`. Options which are not listed stay strings.
+CONFIG_OPTION_GETTERS = {
+    'Meta': {
+        'monitoring': 'getboolean',
+    },
+    'Environment': {
+        'managed_network': 'getboolean',
+        'managed_software': 'getboolean',
+    },
+    'Output': {
+        'syslog': 'getboolean',
+        'csv': 'getboolean',
+        'logstash': 'getboolean',
+        'logstash_port': 'getint',
+        'logstash_batch_size': 'getint',
+        'logstash_batch_max_bytes': 'getint',
+        'logstash_batch_flush_interval': 'getfloat',
+        'logstash_queue_size': 'getint',
+        'logstash_queue_put_timeout': 'getfloat',
+        'logstash_zlib_framing': 'getboolean',
+        'spool_max_megabytes': 'getfloat',
+        'spool_max_events': 'getint',
+        'catch_up_batch_size': 'getint',
+        'catch_up_max_events_per_second': 'getfloat',
+        'logstash_via_scp': 'getboolean',
+        'logstash_via_scp_incremental': 'getboolean',
+        'collector_worker_count': 'getint',
+        'collector_deduplication': 'getboolean',
+        'collector_deduplication_window_days': 'getint',
+        'collector_deduplication_capacity': 'getint',
+    },
+    'Screenshots': {
+        'screenshot_maintenance_interval_hours': 'getfloat',
+        'screenshot_dedupe_max_distance': 'getint',
+        'screenshot_archive_after_days': 'getint',
+        'screenshot_retention_max_mb': 'getint',
+    },
+}
+
+# Getters of the options of the per-test sections which are named after the test.
+TEST_CONFIG_OPTION_GETTERS = {
+    'iterations': 'getint',
+    'warm_up_iterations': 'getint',
+    'cold_iterations': 'getint',
+    # Defined further down.
+    'enabled_processes': lambda value: parse_enabled_processes(value),
+    'screenshot_ring_buffer_frames': 'getint',
+    'screenshot_ring_buffer_interval': 'getfloat',
+    'screenshot_ring_buffer_scale': 'getfloat',
+    'screenshot_ring_buffer_quality': 'getfloat',
+}
+
+
+def get_config_option_getter(section, option):
+    if section in CONFIG_OPTION_GETTERS:
+        return CONFIG_OPTION_GETTERS[section].get(option, 'get')
+    return TEST_CONFIG_OPTION_GETTERS.get(option, 'get')
+
+
+def parse_config_value(config, section, option):
+    getter = get_config_option_getter(section, option)
+    if callable(getter):
+        return getter(config.get(section, option))
+    return getattr(config, getter)(section, option)
+
+
+def parse_config_values(config):
+    """
+    Typed values of all options of `config` by `(section, option)`.
+    Invalid values are left out so that they raise on access like before.
+    """
+    values = {}
+    for section in config.sections():
+        for option in config.options(section):
+            try:
+                values[(section, option)] = parse_config_value(config, section, option)
+            except ValueError:
+                pass
+    return values
+
+
+def get_config_value(config, section, option):
+    """
+    Typed value of a required option, refer to `CONFIG_OPTION_GETTERS`.
+    Raises like ConfigParser if it is missing. For the config returned by
+    `get_config`, the value was parsed when the file was read.
+    """
+    if config is config_cache.get('config'):
+        values = config_cache['values']
+        if (section, option) in values:
+            return values[(section, option)]
+
+    return parse_config_value(config, section, option)
+
+
+def get_config_file_path_cached():
+    """Like `get_config_file_path` but only searches again if the found file does not exist anymore."""
+    config_file_path = config_cache.get('file_path')
+    if config_file_path is None or not os.path.exists(config_file_path):
+        config_file_path = get_config_file_path()
+        config_cache['file_path'] = config_file_path
+    return config_file_path
+
+
+def get_config(reload=False):
+    """
+    Return the ConfigParser shared by the process. The file is only read
+    again if its modification time or size changed. Do not modify it.
+    The typed values of all options are prepared at the same time, refer
+    to `get_config_value`.
+    """
+    config_file_path = get_config_file_path_cached()
+    stat = os.stat(config_file_path)
+    file_key = (config_file_path, stat.st_mtime, stat.st_size)
+
+    if reload or config_cache.get('file_key') != file_key:
+        config = load_config(config_file_path)
+        config_cache['values'] = parse_config_values(config)
+        config_cache['config'] = config
+        config_cache['file_key'] = file_key
+
+    return config_cache['config']
+
+
 def delete_files_in_dir(dir_path):
     for f in glob.glob(dir_path + '/*'):
         os.remove(f)
@@ -522,10 +2085,106 @@ def get_python_install_dir_path(py_version=3):
     return glob.glob('c:/Python' + str(py_version) + '*')[0]
 
 
+def get_ship_log_events_lock_file_path():
+    return get_spool_path() + '/ship_log_events.lock'
+
+
+def get_ship_log_events_request_file_path():
+    return get_spool_path() + '/ship_log_events.requested'
+
+
+def try_lock_file(lock_file_path):
+    """
+    Take an exclusive lock on `lock_file_path` without blocking. Returns the
+    open lock file or None if another process holds the lock. The operating
+    system releases the lock when the process dies.
+    """
+    lock_fh = open(lock_file_path, 'a')
+    try:
+        try:
+            import msvcrt
+        except ImportError:
+            import fcntl
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_fh.seek(0)
+            msvcrt.locking(lock_fh.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        lock_fh.close()
+        return None
+
+    return lock_fh
+
+
+def unlock_file(lock_fh):
+    try:
+        import msvcrt
+    except ImportError:
+        import fcntl
+        fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_fh.seek(0)
+        msvcrt.locking(lock_fh.fileno(), msvcrt.LK_UNLCK, 1)
+    lock_fh.close()
+
+
+def ship_log_events():
+    """
+    Drain the spool and ship events.db in one process. Only one instance
+    does the work at a time. Others leave a request which the running
+    instance picks up before it exits, so no event waits for the next run.
+    Returns False if the work was left to the running instance.
+    """
+    request_file_path = get_ship_log_events_request_file_path()
+    open(request_file_path, 'a').close()
+
+    # The request is checked again after unlocking because it could have
+    # been made after the last pass but before the lock was released.
+    shipped = False
+    while os.path.exists(request_file_path):
+        lock_fh = try_lock_file(get_ship_log_events_lock_file_path())
+        if lock_fh is None:
+            break
+
+        try:
+            while os.path.exists(request_file_path):
+                os.remove(request_file_path)
+                # Runs in the background, the events would only fill the log.
+                process_log_events(print_events=False)
+                scp_log_events()
+                shipped = True
+        finally:
+            unlock_file(lock_fh)
+
+    return shipped
+
+
 def run_process_log_events():
+    """
+    Start ../tools/ship_log_events.py in the background and return without
+    waiting for it. Events are already durable in the spool at this point.
+    """
+    py_inst_dir_path = get_python_install_dir_path(py_version=2)
+    subprocess.Popen(
+        [py_inst_dir_path + '/pythonw.exe', './tools/ship_log_events.py'],
+        stdout=DEVNULL, stderr=DEVNULL)
+
+
+def run_screenshot_maintenance(config):
+    """
+    Start ../tools/maintain_screenshots.py in the background if it did not
+    run within `screenshot_maintenance_interval_hours`.
+    """
+    interval_hours = get_config_option(config, 'Screenshots', 'screenshot_maintenance_interval_hours', 24)
+    stamp_file_path = get_cache_path() + '/screenshot_maintenance.stamp'
+    if os.path.exists(stamp_file_path) and time.time() - os.path.getmtime(stamp_file_path) < interval_hours * 3600:
+        return
+
+    open(stamp_file_path, 'w').close()
     py_inst_dir_path = get_python_install_dir_path(py_version=2)
-    subprocess.call([py_inst_dir_path + '/python.exe', './tools/process_log_events.py'], stdout=subprocess.PIPE)
-    subprocess.call([py_inst_dir_path + '/python.exe', './tools/scp_log_events.py'], stdout=subprocess.PIPE)
+    subprocess.Popen(
+        [py_inst_dir_path + '/pythonw.exe', './tools/maintain_screenshots.py'],
+        stdout=DEVNULL, stderr=DEVNULL)
 
 
 def run_check_if_process_is_running(exe):
@@ -533,9 +2192,112 @@ def run_check_if_process_is_running(exe):
     return not subprocess.call([py_inst_dir_path + '/python.exe', './tools/check_if_process_is_running.py', exe], stdout=DEVNULL)
 
 
-@lru_cache(maxsize=32)
+def run_check_if_processes_are_running(exes):
+    """Check multiple processes with one run of ../tools/check_if_process_is_running.py. Returns a dict."""
+    py_inst_dir_path = get_python_install_dir_path(py_version=2)
+    process = subprocess.Popen(
+        [py_inst_dir_path + '/python.exe', './tools/check_if_process_is_running.py', '--json'] + list(exes),
+        stdout=subprocess.PIPE)
+    stdout = process.communicate()[0]
+    try:
+        return json.loads(stdout.decode('utf-8'))
+    except ValueError:
+        # psutil is not installed.
+        return dict((exe, False) for exe in exes)
+
+
+# Refer to ../tools/process_watch_service.py.
+PROCESS_WATCH_SERVICE_ADDRESS = ('127.0.0.1', 50573)
+
+# Seconds for which answers of the process watch service are reused.
+PROCESS_WATCH_CACHE_TTL = 5
+
+# Seconds for which answers of ../tools/check_if_process_is_running.py are
+# reused while the service is not reachable. Longer as it is expensive.
+PROCESS_WATCH_FALLBACK_CACHE_TTL = 60
+
+process_is_running_cache = {}
+process_watch_service_start_attempted = []
+
+
+def query_process_watch_service(search, timeout=0.2):
+    """Returns if a process matching `search` is running or None if the service is not reachable."""
+    try:
+        sock = socket.create_connection(PROCESS_WATCH_SERVICE_ADDRESS, timeout)
+    except socket.error:
+        return None
+
+    try:
+        sock.sendall((search + '\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            data = sock.recv(16)
+            if not data:
+                return None
+            response += data
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+    return response.strip() == b'1'
+
+
+def start_process_watch_service():
+    """Start the service in the background, once per interpreter. It exits by itself if it already runs."""
+    if process_watch_service_start_attempted:
+        return
+    process_watch_service_start_attempted.append(True)
+
+    try:
+        py_inst_dir_path = get_python_install_dir_path(py_version=2)
+        subprocess.Popen(
+            [py_inst_dir_path + '/pythonw.exe', './tools/process_watch_service.py'],
+            stdout=DEVNULL, stderr=DEVNULL)
+    except (OSError, IndexError):
+        pass
+
+
 def run_check_if_process_is_running_cached(exe):
-    return run_check_if_process_is_running(exe)
+    """
+    Ask the process watch service and reuse its answer for `PROCESS_WATCH_CACHE_TTL` seconds.
+    If the service is not running, run ../tools/check_if_process_is_running.py
+    instead, reuse its answer for `PROCESS_WATCH_FALLBACK_CACHE_TTL` seconds
+    as that is expensive, and start the service so that it is asked once the
+    answer expired.
+    """
+    cached = process_is_running_cache.get(exe)
+    if cached is not None:
+        expires, is_running = cached
+        if time.time() < expires:
+            return is_running
+
+    is_running = query_process_watch_service(exe)
+    if is_running is not None:
+        process_is_running_cache[exe] = (time.time() + PROCESS_WATCH_CACHE_TTL, is_running)
+        return is_running
+
+    is_running = run_check_if_process_is_running(exe)
+    process_is_running_cache[exe] = (time.time() + PROCESS_WATCH_FALLBACK_CACHE_TTL, is_running)
+    start_process_watch_service()
+
+    return is_running
+
+
+def warm_up_process_is_running_cache(exes):
+    """
+    Fill the cache used by `run_check_if_process_is_running_cached` for all
+    `exes` with one process list walk if the process watch service is not running.
+    """
+    now = time.time()
+    exes = [exe for exe in exes if exe not in process_is_running_cache or process_is_running_cache[exe][0] <= now]
+    if not exes or query_process_watch_service(exes[0]) is not None:
+        return
+
+    expires = time.time() + PROCESS_WATCH_FALLBACK_CACHE_TTL
+    for exe, is_running in run_check_if_processes_are_running(exes).items():
+        process_is_running_cache[exe] = (expires, is_running)
+    start_process_watch_service()
 
 
 FACTER_FILE_PATH = 'c:/Program Files/Puppet Labs/Puppet/bin/facter.bat'
@@ -564,11 +2326,214 @@ def run_check_if_running_as_vm_imvirt():
     ], stdout=DEVNULL)
 
 
-def get_enabled_processes_as_set(e2e_test):
+def get_fact_cache_file_path():
+    return get_cache_path() + '/facts.json'
+
+
+def read_fact_cache():
+    return read_json_file(get_fact_cache_file_path(), {})
+
+
+def get_cached_fact(fact_name, fact_function, cache_key_function):
+    """
+    Return the value of `fact_function()` from the on-disk fact cache.
+
+    The cached value is used as long as `cache_key_function()` returns the
+    same value as when the fact was computed. A cache key of None means the
+    key could not be determined and the fact is always computed.
+    """
+    cache_key = cache_key_function()
+    if cache_key is None:
+        return fact_function()
+
+    cache_entry = read_fact_cache().get(fact_name)
+    if cache_entry is not None and cache_entry.get('cache_key') == cache_key:
+        return cache_entry['value']
+
+    fact_value = fact_function()
+
+    # Read again to keep what other processes wrote in the meantime.
+    fact_cache = read_fact_cache()
+    fact_cache[fact_name] = {
+        'cache_key': cache_key,
+        'value': fact_value,
+    }
+    try:
+        write_json_file_atomically(get_fact_cache_file_path(), fact_cache)
+    except (IOError, OSError):
+        # Another process is replacing the file right now. We retry on the next miss.
+        pass
+
+    return fact_value
+
+
+def get_boot_time_cache_key():
+    if 'uptime' not in globals():
+        return None
+
+    uptime_seconds = uptime.uptime()
+    if uptime_seconds is None:
+        return None
+
+    # Rounded because boot time is derived from two clocks which are read at slightly different times.
+    return ['boot_time', int(round((time.time() - uptime_seconds) / 10.0))]
+
+
+def get_file_mtime(file_path):
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return None
+
+
+def get_git_head_cache_key(git_dir_path='.git'):
+    head_file_path = git_dir_path + '/HEAD'
+    if not os.path.isfile(head_file_path):
+        return None
+
+    head_fh = open(head_file_path, 'r')
+    head = head_fh.read().strip()
+    head_fh.close()
+
+    cache_key = ['git_head', head, get_file_mtime(head_file_path), get_file_mtime(git_dir_path + '/packed-refs')]
+    if head.startswith('ref: '):
+        cache_key.append(get_file_mtime(git_dir_path + '/' + head[len('ref: '):]))
+
+    return cache_key
+
+
+def find_executable_in_path(name):
+    for dir_path in os.environ.get('PATH', '').split(os.pathsep):
+        for file_name in [name, name + '.exe']:
+            file_path = os.path.join(dir_path, file_name)
+            if os.path.isfile(file_path):
+                return file_path
+
+    return None
+
+
+def get_java_executable_cache_key():
+    java_file_path = find_executable_in_path('java')
+    if java_file_path is None:
+        return None
+
+    return ['java_executable', java_file_path, get_file_mtime(java_file_path)]
+
+
+def get_os_release_id_cached():
+    return get_cached_fact('os_release_id', get_os_release_id, get_boot_time_cache_key)
+
+
+def run_check_if_running_as_vm_imvirt_cached():
+    return get_cached_fact('virtual_machine', run_check_if_running_as_vm_imvirt, get_boot_time_cache_key)
+
+
+def get_java_version_cached():
+    return get_cached_fact('java_version', get_java_version, get_java_executable_cache_key)
+
+
+def get_git_commit_hash_cached():
+    return get_cached_fact('commit_hash', get_git_commit_hash, get_git_head_cache_key)
+
+
+def process_dependencies(depends_on=(), uses_ui=True):
+    """
+    Decorator for the `run_process_*` functions of a test declaring the
+    names of the processes they depend on and if they use the UI.
+    Refer to `run_processes_by_dependencies`.
+    """
+    def decorator(function):
+        function.depends_on = list(depends_on)
+        function.uses_ui = uses_ui
+        return function
+    return decorator
+
+
+def run_processes_by_dependencies(processes, run_process, max_concurrent=4):
+    """
+    Run `processes`, a list of `(name, function)` tuples, as declared with
+    `process_dependencies`. `run_process(name, function)` returns if the
+    process succeeded.
+
+    Processes without `process_dependencies` depend on `init` and use the UI.
+    A process only runs once all processes it depends on succeeded. If one
+    of them failed or was skipped, it is skipped right away. Processes using
+    the UI run one after another in the calling thread, in the given order.
+    The others run concurrently in threads. Dependencies on processes which
+    are not in `processes` (not enabled) are ignored.
+
+    Returns a dict with `succeeded`, `failed` or `skipped` by process name.
+    """
+    names = [name for name, _ in processes]
+    functions = dict(processes)
+    dependencies = dict(
+        (name, [d for d in getattr(function, 'depends_on', [] if name == 'init' else ['init']) if d in functions])
+        for name, function in processes)
+    states = {}
+    running = set()
+    condition = threading.Condition()
+
+    def run(name):
+        succeeded = False
+        try:
+            succeeded = run_process(name, functions[name])
+        finally:
+            condition.acquire()
+            try:
+                states[name] = 'succeeded' if succeeded else 'failed'
+                running.discard(name)
+                condition.notify_all()
+            finally:
+                condition.release()
+
+    while True:
+        ui_name = None
+        condition.acquire()
+        try:
+            changed = False
+            for name in names:
+                if name in states or name in running:
+                    continue
+
+                dependency_states = [states.get(d) for d in dependencies[name]]
+                if 'failed' in dependency_states or 'skipped' in dependency_states:
+                    states[name] = 'skipped'
+                    changed = True
+                elif all(state == 'succeeded' for state in dependency_states):
+                    if getattr(functions[name], 'uses_ui', True):
+                        if ui_name is None:
+                            ui_name = name
+                    elif len(running) < max_concurrent:
+                        running.add(name)
+                        thread = threading.Thread(target=run, args=(name,), name='process_' + name)
+                        thread.daemon = True
+                        thread.start()
+                        changed = True
+
+            if ui_name is None and not changed:
+                if running:
+                    condition.wait()
+                    continue
+                # Done or the remaining processes depend on each other.
+                for name in names:
+                    states.setdefault(name, 'skipped')
+                break
+
+            if ui_name is not None:
+                running.add(ui_name)
+        finally:
+            condition.release()
+
+        if ui_name is not None:
+            run(ui_name)
+
+    return states
+
+
+def parse_enabled_processes(enabled_processes):
     enabled_process_names = set()
-    config = get_config()
 
-    for enabled_process in config.get(e2e_test, 'enabled_processes').split('\n'):
+    for enabled_process in enabled_processes.split('\n'):
 
         if not enabled_process or re.search(r'\s[#;]', enabled_process):
             continue
@@ -581,3 +2546,8 @@ def get_enabled_processes_as_set(e2e_test):
         enabled_process_names.add(enabled_process)
 
     return enabled_process_names
+
+
+def get_enabled_processes_as_set(e2e_test):
+    # Callers add to it.
+    return set(get_config_value(get_config(), e2e_test, 'enabled_processes'))
@@ -16,13 +16,22 @@ __copyright__ = [
     'Copyright (C) 2016-2018 Geberit Verwaltungs GmbH https://www.geberit.de',
 ]
 
+import re
 import time
 import logging
 import shutil
 import types
+import traceback
+import threading
+import collections
 
 from sikuli import *
 
+from java.awt import RenderingHints
+from java.awt.image import BufferedImage
+from java.io import File
+from javax.imageio import IIOImage, ImageIO, ImageWriteParam
+
 import common
 
 logger = logging.getLogger(__name__)
@@ -33,24 +42,219 @@ def take_screenshot():
     # 'path', 'filename').getFile() but it does not work as of 1.1.3.
     file_path = SCREEN.capture().getFile()
 
-    screenshot_file_path = common.get_screenshot_path() + '/' + common.get_filename_save_cur_timestamp() + '.png'
+    # The test name lets ../tools/maintain_screenshots.py only compare screenshots of the same test.
+    screenshot_file_path = '%s/%s_%s.png' % (
+        common.get_screenshot_path(), common.get_filename_save_cur_timestamp(), common.get_script_name())
     shutil.move(file_path, screenshot_file_path)
 
 
+PATTERN_IMAGE_NAME_REGEX = re.compile(r'''["']([^"'\n]+\.png)["']''')
+
+
+def find_pattern_image_names(script_file_path):
+    """Return the pattern image names used as string literals in `script_file_path`."""
+    script_fh = open(script_file_path, 'r')
+    try:
+        image_names = set(PATTERN_IMAGE_NAME_REGEX.findall(script_fh.read()))
+    finally:
+        script_fh.close()
+    return sorted(image_names)
+
+
+def preload_pattern_images(image_names):
+    """
+    Load and decode all `image_names` into the SikuliX image cache so that
+    this does not happen within time measurements later.
+    Raises if any image is missing. Returns how many images were loaded and
+    the seconds this took, which would otherwise be in measured sections.
+    """
+    start_time = time.time()
+    missing_image_names = []
+    for image_name in image_names:
+        image = Image.create(image_name)
+        if not image.isValid() or image.get() is None:
+            missing_image_names.append(image_name)
+
+    if missing_image_names:
+        raise Exception("Pattern images not found: " + ', '.join(missing_image_names))
+
+    return {
+        'image_count': len(image_names),
+        'seconds': time.time() - start_time,
+    }
+
+
+def downscale_image(image, scale):
+    width = max(1, int(image.getWidth() * scale))
+    height = max(1, int(image.getHeight() * scale))
+    scaled_image = BufferedImage(width, height, BufferedImage.TYPE_INT_RGB)
+    graphics = scaled_image.createGraphics()
+    try:
+        graphics.setRenderingHint(RenderingHints.KEY_INTERPOLATION, RenderingHints.VALUE_INTERPOLATION_BILINEAR)
+        graphics.drawImage(image, 0, 0, width, height, None)
+    finally:
+        graphics.dispose()
+    return scaled_image
+
+
+def write_image(image, file_path, image_format='png', quality=0.75):
+    """Write a BufferedImage. `quality` (0 to 1) is used for lossy formats like jpg."""
+    if image_format == 'png':
+        ImageIO.write(image, image_format, File(file_path))
+        return
+
+    writer = ImageIO.getImageWritersByFormatName(image_format).next()
+    output = ImageIO.createImageOutputStream(File(file_path))
+    try:
+        write_param = writer.getDefaultWriteParam()
+        write_param.setCompressionMode(ImageWriteParam.MODE_EXPLICIT)
+        write_param.setCompressionQuality(quality)
+        writer.setOutput(output)
+        writer.write(None, IIOImage(image, None, None), write_param)
+    finally:
+        output.close()
+        writer.dispose()
+
+
+class ScreenshotRingBuffer(object):
+    """
+    Captures downscaled screenshots in the background and keeps the last
+    `frame_count` of them in memory. On failure, `save_async` writes them
+    together with a current one to `common.get_screenshot_path()` without
+    blocking the workflow. Capturing is paused during time measurements,
+    refer to `pause`.
+    """
+
+    def __init__(self, frame_count=10, interval=1.0, scale=0.5, image_format='jpg', quality=0.75):
+        self.interval = interval
+        self.scale = scale
+        self.image_format = image_format
+        self.quality = quality
+        self.frames = collections.deque(maxlen=frame_count)
+        self.frames_lock = threading.Lock()
+        # Held while capturing so that `pause` can wait for a running capture.
+        self.capture_lock = threading.Lock()
+        self.paused_counts_by_thread = {}
+        self.stopped = threading.Event()
+        self.capture_thread = None
+        self.save_threads = []
+
+    def capture_frame(self):
+        frame = (common.get_filename_save_cur_timestamp(), downscale_image(SCREEN.capture().getImage(), self.scale))
+        with self.frames_lock:
+            self.frames.append(frame)
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.capture_lock:
+                if not self.paused_counts_by_thread:
+                    try:
+                        self.capture_frame()
+                    except Exception:
+                        logger.exception("Capturing a screenshot for the ring buffer failed.")
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.capture_thread = threading.Thread(target=self.run, name='screenshot_ring_buffer')
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+        active_screenshot_ring_buffers.append(self)
+
+    def pause(self):
+        """
+        Stop capturing until `resume` is called from the same thread so that
+        captures do not add to measured sections. Waits for a running capture.
+        Calls can be nested and come from multiple threads.
+        """
+        current_thread = threading.current_thread()
+        with self.capture_lock:
+            self.paused_counts_by_thread[current_thread] = self.paused_counts_by_thread.get(current_thread, 0) + 1
+
+    def resume(self):
+        current_thread = threading.current_thread()
+        with self.capture_lock:
+            paused_count = self.paused_counts_by_thread.pop(current_thread, 0) - 1
+            if paused_count > 0:
+                self.paused_counts_by_thread[current_thread] = paused_count
+
+    def save(self):
+        self.capture_frame()
+        with self.frames_lock:
+            frames = list(self.frames)
+            self.frames.clear()
+
+        screenshot_path = common.get_screenshot_path()
+        for frame_number, (timestamp, image) in enumerate(frames):
+            file_path = '%s/%s_ring_buffer_%02d.%s' % (screenshot_path, timestamp, frame_number, self.image_format)
+            write_image(image, file_path, self.image_format, self.quality)
+
+    def save_async(self):
+        # The measurement of the failed process is never stopped.
+        with self.capture_lock:
+            self.paused_counts_by_thread.pop(threading.current_thread(), None)
+
+        save_thread = threading.Thread(target=self.save, name='screenshot_ring_buffer_save')
+        save_thread.start()
+        self.save_threads.append(save_thread)
+
+    def stop(self, timeout=None):
+        """Stop capturing and wait for pending saves."""
+        if self in active_screenshot_ring_buffers:
+            active_screenshot_ring_buffers.remove(self)
+        self.stopped.set()
+        if self.capture_thread:
+            self.capture_thread.join(timeout)
+        for save_thread in self.save_threads:
+            save_thread.join(timeout)
+
+
+# Started ring buffers, paused by `start_time_measurement`.
+active_screenshot_ring_buffers = []
+
+
+def get_screenshot_ring_buffer(config, section):
+    """Return a started ScreenshotRingBuffer if it is enabled in the config `section`, else None."""
+    frame_count = common.get_config_option(config, section, 'screenshot_ring_buffer_frames', 0)
+    if frame_count <= 0:
+        return None
+
+    screenshot_ring_buffer = ScreenshotRingBuffer(
+        frame_count=frame_count,
+        interval=common.get_config_option(config, section, 'screenshot_ring_buffer_interval', 1.0),
+        scale=common.get_config_option(config, section, 'screenshot_ring_buffer_scale', 0.5),
+        image_format=common.get_config_option(config, section, 'screenshot_ring_buffer_format', 'jpg'),
+        quality=common.get_config_option(config, section, 'screenshot_ring_buffer_quality', 0.75),
+    )
+    screenshot_ring_buffer.start()
+    return screenshot_ring_buffer
+
+
 # Useful for debugging and transparency when communicating with CRM team.
 # This is a side effect of my work on the neo-vars AutoHotKey script.
 # Run ../tools/show_time_measure_tray_icon.ahk before.
+# Returns a common.TimeMeasurement, its `raw_duration` is available after stopping.
 def start_time_measurement():
-    start_measurement_time = time.time()
+    for screenshot_ring_buffer in active_screenshot_ring_buffers:
+        screenshot_ring_buffer.pause()
+
+    measurement = common.TimeMeasurement()
 
     show_time_measure_tray_icon_is_running = common.run_check_if_process_is_running_cached('show_time_measure_tray_icon')
 
     if show_time_measure_tray_icon_is_running:
         type("I", KeyModifier.WIN)
-    return start_measurement_time
 
-def stop_time_measurement(start_time):
-    measurement_duration = time.time() - start_time
+    measurement.started()
+    return measurement
+
+# Returns the duration without the instrumentation overhead.
+# Pass 0 instead of a measurement to only signal the tray icon.
+def stop_time_measurement(measurement):
+    measurement_duration = None
+    if isinstance(measurement, common.TimeMeasurement):
+        measurement_duration = measurement.stop()
+        for screenshot_ring_buffer in active_screenshot_ring_buffers:
+            screenshot_ring_buffer.resume()
 
     show_time_measure_tray_icon_is_running = common.run_check_if_process_is_running_cached('show_time_measure_tray_icon')
 
@@ -79,7 +283,173 @@ def stop_screen_recording():
         sleep(1)
 
 
-def waitMultiple(patterns, wait_timeout):
+def get_pattern_location_cache_file_path():
+    return common.get_cache_path() + '/pattern_locations.json'
+
+
+def get_pattern_cache_key(pattern):
+    if isinstance(pattern, basestring):
+        return pattern
+    return str(pattern.getFilename()) + ':' + str(pattern.getSimilar())
+
+
+class PatternLocationCache(object):
+    """
+    Remembers where each pattern was last found, persisted between runs.
+    Lookups search a padded region around that location first and only fall
+    back to searching the whole screen if the pattern is not there.
+    """
+
+    def __init__(self, file_path, padding=50):
+        self.file_path = file_path
+        self.padding = padding
+        self.locations = common.read_json_file(file_path, default={})
+        self.changed = False
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'hit_seconds': 0.0,
+            'miss_seconds': 0.0,
+        }
+
+    def get_hint_region(self, pattern):
+        location = self.locations.get(get_pattern_cache_key(pattern))
+        if location is None:
+            return None
+
+        x, y, w, h = location
+        return Region(
+            x - self.padding, y - self.padding,
+            w + 2 * self.padding, h + 2 * self.padding,
+        ).intersection(SCREEN)
+
+    def remember(self, pattern, match):
+        location = [match.getX(), match.getY(), match.getW(), match.getH()]
+        key = get_pattern_cache_key(pattern)
+        if self.locations.get(key) != location:
+            self.locations[key] = location
+            self.changed = True
+
+    def exists(self, pattern, timeout=0):
+        """Like SikuliX `exists` but try the last location first. Returns the match or None."""
+        hint_region = self.get_hint_region(pattern)
+        if hint_region is not None:
+            start_time = time.time()
+            match = hint_region.exists(pattern, 0)
+            if match:
+                self.stats['hits'] += 1
+                self.stats['hit_seconds'] += time.time() - start_time
+                self.remember(pattern, match)
+                return match
+
+        start_time = time.time()
+        match = SCREEN.exists(pattern, timeout)
+        self.stats['misses'] += 1
+        self.stats['miss_seconds'] += time.time() - start_time
+        if match:
+            self.remember(pattern, match)
+        return match
+
+    def save(self):
+        if self.changed:
+            common.write_json_file_atomically(self.file_path, self.locations)
+            self.changed = False
+
+
+pattern_location_cache = None
+
+
+def get_pattern_location_cache():
+    global pattern_location_cache
+    if pattern_location_cache is None:
+        pattern_location_cache = PatternLocationCache(get_pattern_location_cache_file_path())
+    return pattern_location_cache
+
+
+def existsWithLocationHint(pattern, timeout=0):
+    return get_pattern_location_cache().exists(pattern, timeout)
+
+
+def save_pattern_location_cache():
+    """Persist the pattern locations and return the hit/miss statistics for the log event."""
+    cache = get_pattern_location_cache()
+    cache.save()
+    return dict(cache.stats)
+
+
+def find_patterns_in_screen_image(patterns, screen_image, best_match=False):
+    """
+    Match all `patterns` against one captured `screen_image`.
+    Returns the first pattern found (in the order of `patterns`) or with
+    `best_match`, the one with the highest score, or None.
+    """
+    found_pattern = None
+    found_score = None
+
+    finder = Finder(screen_image, SCREEN)
+    try:
+        for pattern in patterns:
+            finder.find(pattern)
+            if not finder.hasNext():
+                continue
+
+            score = finder.next().getScore()
+            if found_score is None or score > found_score:
+                found_pattern = pattern
+                found_score = score
+                if not best_match:
+                    break
+    finally:
+        finder.destroy()
+
+    if found_pattern is not None:
+        logger.debug("Found " + str(found_pattern) + " with score " + str(found_score))
+    return found_pattern
+
+
+def waitMultipleSingleCapture(patterns, wait_timeout, best_match=False, sleep_seconds=0.25):
+    """
+    Like `waitMultiple` but capture the screen once per pass and match all
+    `patterns` against that capture. The measured pass duration is used to
+    decide if another pass fits into `wait_timeout`.
+    """
+    start_time = time.time()
+    pass_duration = 0
+    pass_count = 0
+    while True:
+        pass_start_time = time.time()
+        found_pattern = find_patterns_in_screen_image(patterns, SCREEN.capture(), best_match=best_match)
+        pass_duration = time.time() - pass_start_time
+        pass_count += 1
+
+        if found_pattern is not None:
+            break
+
+        remaining_seconds = wait_timeout - (time.time() - start_time)
+        if remaining_seconds < pass_duration:
+            break
+        sleep(min(sleep_seconds, remaining_seconds - pass_duration))
+
+    logger.debug("waitMultiple ran " + str(pass_count) + " passes, the last took " + str(pass_duration) + " s")
+
+    if found_pattern is None:
+        # Seems we can not easily raise a real FindFailed exception.
+        raise Exception("Custom FindFailed exception: waitMultiple did not find any of the patterns.")
+
+    logger.debug("waitMultiple found_pattern: " + str(found_pattern))
+    return found_pattern
+
+
+def waitMultiple(patterns, wait_timeout, single_capture=False, best_match=False):
+    """
+    Wait until one of `patterns` appears and return it.
+
+    With `single_capture`, refer to `waitMultipleSingleCapture`. Otherwise,
+    each pattern is searched with its own screen capture.
+    """
+    if single_capture:
+        return waitMultipleSingleCapture(patterns, wait_timeout, best_match=best_match)
+
     found_pattern = False
 
     # Image recognison takes a bit.
@@ -92,7 +462,7 @@ def waitMultiple(patterns, wait_timeout):
     for _ in range(1, number_of_iterations):
         logger.debug("waitMultiple iteration: " + str(_))
         for pattern in patterns:
-            if exists(pattern, timeout_for_pattern):
+            if existsWithLocationHint(pattern, timeout_for_pattern):
                 found_pattern = pattern
                 break
 
@@ -109,56 +479,187 @@ def waitMultiple(patterns, wait_timeout):
     return found_pattern
 
 
-# TODO: Implement, run_action_sequence(actions, repeat_count=15, sleep_seconds=1)
-# `actions` example [Pattern(), [Pattern(), Pattern()], Pattern()]
-# Run all actions in sequence. If one fails, start from the beginning.
+action_sequence_metrics = []
+
+
+def run_action(action, timeout):
+    """
+    Run one step of `run_action_sequence`. A function is called, a pattern
+    is clicked and for a list of patterns, the first one which appears is clicked.
+    """
+    if isinstance(action, types.FunctionType):
+        action()
+    elif isinstance(action, list):
+        click(waitMultiple(action, timeout, single_capture=True))
+    else:
+        match = existsWithLocationHint(action, timeout)
+        if not match:
+            raise Exception("Custom FindFailed exception: " + str(action) + " did not appear.")
+        click(match)
+
+
+def run_action_sequence(actions, repeat_count=15, sleep_seconds=1, step_timeout=10):
+    """
+    Run all `actions` in sequence, refer to `run_action` for what an action can be.
+    An action can also be given as `(action, checkpoint_pattern)`. The step
+    is only done once `checkpoint_pattern` appeared and it becomes the
+    checkpoint. If a later step fails and the checkpoint pattern is still
+    visible, the sequence continues after the checkpoint. Otherwise, it
+    starts from the beginning. Gives up after `repeat_count` failures.
+
+    Returns the metrics which are also added to `action_sequence_metrics`.
+    """
+    steps = [action if isinstance(action, tuple) else (action, None) for action in actions]
+    metrics = {
+        'step_seconds': [None] * len(steps),
+        'step_retries': [0] * len(steps),
+        'resumes': 0,
+        'restarts': 0,
+    }
+    action_sequence_metrics.append(metrics)
+
+    checkpoint_step = None
+    failure_count = 0
+    step = 0
+    while step < len(steps):
+        action, checkpoint_pattern = steps[step]
+        start_time = common.get_monotonic_time()
+        try:
+            run_action(action, step_timeout)
+            if checkpoint_pattern is not None:
+                if not existsWithLocationHint(checkpoint_pattern, step_timeout):
+                    raise Exception("Custom FindFailed exception: checkpoint " + str(checkpoint_pattern) + " did not appear.")
+                checkpoint_step = step
+        # FindFailed does not inherit from Exception!!!
+        except (Exception, FindFailed):
+            failure_count += 1
+            metrics['step_retries'][step] += 1
+            logger.debug("Step " + str(step) + " of the action sequence failed: " + traceback.format_exc().strip())
+            if failure_count > repeat_count:
+                raise Exception("Endless loop in run_action_sequence.")
+
+            sleep(sleep_seconds)
+            if checkpoint_step is not None and existsWithLocationHint(steps[checkpoint_step][1], 0):
+                metrics['resumes'] += 1
+                step = checkpoint_step + 1
+            else:
+                metrics['restarts'] += 1
+                checkpoint_step = None
+                step = 0
+            continue
+
+        metrics['step_seconds'][step] = common.get_monotonic_time() - start_time
+        step += 1
+
+    return metrics
+
+
+def get_poll_intervals(min_interval=0.05, max_interval=1.0, factor=2):
+    """Yield sleep durations which start short and back off up to `max_interval`."""
+    interval = min_interval
+    while True:
+        yield interval
+        interval = min(interval * factor, max_interval)
+
+
+polling_metrics = []
 
 
-def actionUntilExists(action, pattern, repeat_count=15, sleep_seconds=1, click_on_exists=False):
+def record_polling_metric(function_name, pattern, attempt_count, action_count, start_time, success):
+    polling_metrics.append({
+        'function': function_name,
+        'pattern': str(pattern),
+        'attempts': attempt_count,
+        'actions': action_count,
+        'seconds': common.get_monotonic_time() - start_time,
+        'success': success,
+    })
+
+
+def actionUntilExists(action, pattern, timeout=15, action_interval=1, click_on_exists=False):
     """
-       Execute `action` until `pattern` appears.
+       Execute `action` until `pattern` appears, at most every `action_interval` seconds.
        If `action` is a pattern, we click it.
+       In between, `pattern` is polled for, often at first and then backing off.
+       Gives up after `timeout` seconds.
     """
 
-    appeared = False
-    for iteration in range(repeat_count):
-        if exists(pattern, 0.1):
-            appeared = True
+    start_time = common.get_monotonic_time()
+    deadline = start_time + timeout
+    next_action_time = start_time
+    poll_intervals = get_poll_intervals()
+    attempt_count = 0
+    action_count = 0
+    while True:
+        attempt_count += 1
+        match = existsWithLocationHint(pattern, 0)
+        if match:
             break
-        elif isinstance(action, types.FunctionType):
-            action(iteration=iteration)
-        else:
-            click(action)
 
-        sleep(sleep_seconds)
+        now = common.get_monotonic_time()
+        if now >= deadline:
+            break
+
+        if now >= next_action_time:
+            if isinstance(action, types.FunctionType):
+                action(iteration=action_count)
+            else:
+                click(action)
+            action_count += 1
+            next_action_time = common.get_monotonic_time() + action_interval
+            poll_intervals = get_poll_intervals()
 
-    if appeared:
+        sleep(max(0, min(next(poll_intervals), deadline - common.get_monotonic_time())))
+
+    record_polling_metric('actionUntilExists', pattern, attempt_count, action_count, start_time, bool(match))
+
+    if match:
         if click_on_exists:
-            return click(pattern)
+            return click(match)
         else:
             return pattern
     else:
         raise Exception("Endless loop in actionUntilExists.")
 
 
-def clickWhileExists(pattern, repeat_count=15, sleep_seconds=1, action_function=None):
-    """Click on `pattern` or execute `action_function` until `pattern` disappears."""
+def clickWhileExists(pattern, timeout=15, action_interval=1, action_function=None):
+    """
+    Click on `pattern` or execute `action_function` until `pattern` disappears,
+    at most every `action_interval` seconds. In between, poll like `actionUntilExists`.
+    """
 
+    start_time = common.get_monotonic_time()
+    deadline = start_time + timeout
+    next_action_time = start_time
+    poll_intervals = get_poll_intervals()
+    attempt_count = 0
+    action_count = 0
     vanished = False
-    for iteration in range(repeat_count):
-        if iteration != 0:
-            sleep(sleep_seconds)
-
-        if exists(pattern, 0.1):
-            if action_function:
-                action_function(iteration=iteration)
-            else:
-                click(pattern)
-        else:
+    while True:
+        attempt_count += 1
+        match = existsWithLocationHint(pattern, 0)
+        if not match:
             logger.debug(str(pattern) + " vanished")
             vanished = True
             break
 
+        now = common.get_monotonic_time()
+        if now >= deadline:
+            break
+
+        if now >= next_action_time:
+            if action_function:
+                action_function(iteration=action_count)
+            else:
+                click(match)
+            action_count += 1
+            next_action_time = common.get_monotonic_time() + action_interval
+            poll_intervals = get_poll_intervals()
+
+        sleep(max(0, min(next(poll_intervals), deadline - common.get_monotonic_time())))
+
+    record_polling_metric('clickWhileExists', pattern, attempt_count, action_count, start_time, vanished)
+
     if vanished:
         return pattern
     else:
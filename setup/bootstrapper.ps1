@@ -113,7 +113,7 @@ function Get-Boxstarter {
     ## Also, we might need more current/nightly versions of SikuliX.
 
     ## Soft dependencies. Provides additional functionally like Logstash output and `env.uptime`.
-    c:/python27/scripts/pip2.exe install python-logstash-async simplejson pathlib2 uptime psutil backports.functools_lru_cache
+    c:/python27/scripts/pip2.exe install python-logstash-async simplejson pathlib2 uptime psutil backports.functools_lru_cache pillow
     Assert-LastExitCodeIsZero
 
     ## Soft dependencies. Nice to have for development and debugging:
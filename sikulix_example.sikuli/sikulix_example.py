@@ -49,6 +49,30 @@ Debug.setLogFile(common.get_log_file_path_for_script(suffix='sikulix', subdir=Tr
 
 e2e_metrics = {}
 report_tags = set()
+pattern_preload_stats = {}
+
+# `warm_up`, `cold` or `warm` by iteration count.
+iteration_labels = {}
+# Values of the cold/warm iterations by metric name and label for the summaries.
+metric_values_by_label = {}
+# Number of values per metric name and label, shipped as meta.
+metric_sample_counts = {}
+
+
+def get_iteration_labels(config):
+    iterations = common.get_config_option(config, 'sikulix_example', 'iterations', 1)
+    warm_up_iterations = common.get_config_option(config, 'sikulix_example', 'warm_up_iterations', 0)
+    cold_iterations = common.get_config_option(config, 'sikulix_example', 'cold_iterations', 1)
+
+    labels = {}
+    for iteration_count in range(1, warm_up_iterations + iterations + 1):
+        if iteration_count <= warm_up_iterations:
+            labels[iteration_count] = 'warm_up'
+        elif iteration_count <= warm_up_iterations + cold_iterations:
+            labels[iteration_count] = 'cold'
+        else:
+            labels[iteration_count] = 'warm'
+    return labels
 
 
 def save_metric(metric_name, metric_value, iteration_count):
@@ -58,27 +82,56 @@ def save_metric(metric_name, metric_value, iteration_count):
 
     e2e_metrics[metric_full_name] = metric_value
 
+    label = iteration_labels.get(iteration_count)
+    if label in ('cold', 'warm') and isinstance(metric_value, (int, long, float)):
+        metric_values_by_label.setdefault(metric_name, {}).setdefault(label, []).append(metric_value)
+
     return metric_full_name
 
 
+def save_metric_summaries():
+    """
+    Add the summary statistics of the cold and warm iterations per metric,
+    like `<metric_name>_warm_p90`, for labels with more than one value.
+    The number of values goes to `metric_sample_counts`.
+    """
+    for metric_name, values_by_label in metric_values_by_label.items():
+        for label, values in values_by_label.items():
+            metric_sample_counts.setdefault(metric_name, {})[label] = len(values)
+            if len(values) < 2:
+                continue
+            for statistic, value in common.get_summary_statistics(values).items():
+                if statistic != 'count':
+                    e2e_metrics[metric_name + '_' + label + '_' + statistic] = value
+
+
+@common.process_dependencies(depends_on=['init'])
 def run_process_x(iteration_count, recursion_depth=0):
     process_time = 0
 
     # click()
     
-    start_subprocess_time = sikulix_common.start_time_measurement()
+    measurement = sikulix_common.start_time_measurement()
     # wait()
     sleep(1)
     
-    response_time = sikulix_common.stop_time_measurement(start_subprocess_time)
+    response_time = sikulix_common.stop_time_measurement(measurement)
     process_time += response_time
     save_metric("e2e-sikulix_example-x-01-load_form_XX-response_time", response_time, iteration_count)
+    save_metric("e2e-sikulix_example-x-01-load_form_XX-response_time_raw", measurement.raw_duration, iteration_count)
     save_metric("e2e-sikulix_example-x-process_time", process_time, iteration_count)
 
 
+@common.process_dependencies()
 def run_process_init(iteration_count, recursion_depth=0):
+    # Before any time measurement. Fails early if an image is missing.
+    pattern_preload_stats.update(sikulix_common.preload_pattern_images(
+        sikulix_common.find_pattern_image_names(getBundlePath() + '/sikulix_example.py')))
+
+    # Warm up the process check cache to not have any (noticeable) delay later.
+    common.warm_up_process_is_running_cache(['show_time_measure_tray_icon', 'obs-studio'])
+
     # Ensure time measurement signal is set to stopped.
-    # Also required to warm up lru_cache to not have any (noticeable) delay later.
     sikulix_common.stop_time_measurement(0)
 
     sikulix_common.start_screen_recording()
@@ -91,82 +144,121 @@ def main():
 
     setAutoWaitTimeout(60)
 
+    screenshot_ring_buffer = sikulix_common.get_screenshot_ring_buffer(config, 'sikulix_example')
+
     enabled_process_names = common.get_enabled_processes_as_set('sikulix_example')
     enabled_process_names.add('init')
     logger.debug(enabled_process_names)
 
-    log_event_severity = 'info'
-    log_event_msg = 'sikulix_example SikuliX test workflow completed successfully'
+    run_state = {
+        'log_event_severity': 'info',
+        'log_event_msg': 'sikulix_example SikuliX test workflow completed successfully',
+    }
     exceptions = []
     exception_short = []
+    skipped_processes = []
 
-    # Only one iteration -> How does caching behave is not tested.
-    for iteration_count in [1]:
-
-        # Needed to define the order.
-        supported_processes = [
-            run_process_init,
-            run_process_x,
-        ]
+    iteration_labels.update(get_iteration_labels(config))
 
-        for supported_process in supported_processes:
-            supported_process_name = re.sub(r'^run_process_', '', supported_process.__name__)
-            if supported_process_name not in enabled_process_names:
-                continue
-
-            reason_for_failure = None
+    def run_supported_process(supported_process_name, supported_process, iteration_count):
+        # Processes which do not use the UI run in threads concurrently to
+        # the UI ones, so they must not search the screen or take screenshots.
+        uses_ui = getattr(supported_process, 'uses_ui', True)
+        reason_for_failure = None
+        try:
+            logger.info("Run " + supported_process_name + ".")
             try:
-                logger.info("Run " + supported_process_name + ".")
-                try:
-                    supported_process(iteration_count)
-                except:
-                    # Try to detect the root cause and include it in the exception.
-                    if exists("common error image", 5):
-                        reason_for_failure = 'Our common error occurred.'
-                    else:
-                        raise
-
-                    if reason_for_failure:
-                        exc_class, exc, tb = sys.exc_info()
-                        new_exc = Exception("%s Actual exception: %s (%s)" % (reason_for_failure, exc, exc_class))
-                        raise new_exc.__class__, new_exc, tb
-                logger.info(supported_process_name + " completed successfully.")
-
-            # FindFailed does not inherit from Exception!!!
-            except (Exception, FindFailed):
-                log_event_severity = 'warn'
+                supported_process(iteration_count)
+            except:
+                # Try to detect the root cause and include it in the exception.
+                if uses_ui and exists("common error image", 5):
+                    reason_for_failure = 'Our common error occurred.'
+                else:
+                    raise
 
-                logger.warn(supported_process_name + " failed.")
-
-                logger.exception(traceback.format_exc().strip())
-                exceptions.append(traceback.format_exc().strip())
-
-                exception_short_tmp = []
-                for tb in traceback.extract_tb(sys.exc_info()[2]):
-                    if not tb[3].startswith("supported_process"):
-                        tb_line = str(tb[1]) + ': ' + str(tb[2]) + ': ' + str(tb[3])
-                        # try:
-                            # Does not work.
-                            # tb_line += ': ' + str(tb[4])
-                        # except IndexError: pass
-
-                        exception_short_tmp.append(tb_line)
                 if reason_for_failure:
-                    exception_short_tmp[-1] += ': ' + reason_for_failure
-                exception_short.append('\n'.join(exception_short_tmp))
-
+                    exc_class, exc, tb = sys.exc_info()
+                    new_exc = Exception("%s Actual exception: %s (%s)" % (reason_for_failure, exc, exc_class))
+                    raise new_exc.__class__, new_exc, tb
+            logger.info(supported_process_name + " completed successfully.")
+            return True
+
+        # FindFailed does not inherit from Exception!!!
+        except (Exception, FindFailed):
+            if run_state['log_event_severity'] == 'info':
+                run_state['log_event_severity'] = 'warn'
+
+            logger.warn(supported_process_name + " failed.")
+
+            logger.exception(traceback.format_exc().strip())
+            exceptions.append(traceback.format_exc().strip())
+
+            exception_short_tmp = []
+            for tb in traceback.extract_tb(sys.exc_info()[2]):
+                if not tb[3].startswith("supported_process"):
+                    tb_line = str(tb[1]) + ': ' + str(tb[2]) + ': ' + str(tb[3])
+                    # try:
+                        # Does not work.
+                        # tb_line += ': ' + str(tb[4])
+                    # except IndexError: pass
+
+                    exception_short_tmp.append(tb_line)
+            if reason_for_failure:
+                exception_short_tmp[-1] += ': ' + reason_for_failure
+            exception_short.append('\n'.join(exception_short_tmp))
+
+            if uses_ui:
                 try:
-                    sikulix_common.take_screenshot()
+                    if screenshot_ring_buffer:
+                        screenshot_ring_buffer.save_async()
+                    else:
+                        sikulix_common.take_screenshot()
                 except:
                     report_tags.add('e2e-sikulix_example-unable_to_take_screenshot')
 
-                if supported_process_name == 'init':
-                    log_event_severity = 'error'
-                    log_event_msg = 'sikulix_example SikuliX test workflow failed'
-                    # We can not continue with the processes.
-                    break
+            if supported_process_name == 'init':
+                run_state['log_event_severity'] = 'error'
+                run_state['log_event_msg'] = 'sikulix_example SikuliX test workflow failed'
+            return False
+
+    # Once before all iterations so that preloading, warm-up and the screen
+    # recording are not repeated and do not count as part of an iteration.
+    init_succeeded = run_supported_process('init', run_process_init, 0)
+
+    # Needed to define the order of processes which use the UI.
+    # Refer to `process_dependencies` for dependencies and concurrency.
+    supported_processes = [
+        run_process_x,
+    ]
+
+    # Refer to `iterations` and friends in the config to test how caching behaves.
+    for iteration_count in sorted(iteration_labels):
+        if not init_succeeded:
+            # We can not continue with the processes.
+            break
+
+        logger.info("Run iteration " + str(iteration_count) + " (" + iteration_labels[iteration_count] + ").")
+
+        # Processes which depend on a failed one are skipped.
+        process_states = common.run_processes_by_dependencies(
+            [(re.sub(r'^run_process_', '', supported_process.__name__), supported_process)
+             for supported_process in supported_processes
+             if re.sub(r'^run_process_', '', supported_process.__name__) in enabled_process_names],
+            lambda name, function: run_supported_process(name, function, iteration_count),
+        )
+        for supported_process_name, process_state in sorted(process_states.items()):
+            if process_state == 'skipped':
+                logger.warn(supported_process_name + " skipped because a process it depends on failed.")
+                skipped_processes.append(supported_process_name + '_' + str(iteration_count))
+
+    log_event_severity = run_state['log_event_severity']
+    log_event_msg = run_state['log_event_msg']
+
+    save_metric_summaries()
 
-    if config.getboolean('Output', 'logstash'):
+    pattern_location_cache_stats = sikulix_common.save_pattern_location_cache()
+
+    if common.get_config_value(config, 'Output', 'logstash'):
         common.store_log_event(
             log_event_severity,
             log_event_msg,
@@ -175,8 +267,15 @@ def main():
                 'meta': {
                     'engine_name': Env.getSikuliVersion().split()[0],
                     'sikulix_version': Env.getSikuliVersion().split()[1],
-                    'java_version': common.get_java_version(),
+                    'java_version': common.get_java_version_cached(),
                     'km_processes': list(enabled_process_names),
+                    'iteration_labels': dict((str(k), v) for k, v in iteration_labels.items()),
+                    'metric_sample_counts': metric_sample_counts,
+                    'skipped_processes': skipped_processes,
+                    'pattern_location_cache': pattern_location_cache_stats,
+                    'pattern_preload': pattern_preload_stats,
+                    'polling': sikulix_common.polling_metrics,
+                    'action_sequences': sikulix_common.action_sequence_metrics,
                 },
                 'data': e2e_metrics,
                 'exception': exceptions,
@@ -185,6 +284,11 @@ def main():
         )
         common.run_process_log_events()
 
+    common.run_screenshot_maintenance(config)
+
+    if screenshot_ring_buffer:
+        screenshot_ring_buffer.stop()
+
     # Needed because the SikuliX GUI reuses the same interpreter for multiple runs.
     logging.shutdown()
 
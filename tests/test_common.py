@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import socket
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'includes'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+import common
+from logstash_stand_in_server import start_stand_in_server
+
+
+class TempSpoolTestCase(unittest.TestCase):
+    """Runs with the spool directory in a temporary directory."""
+
+    def setUp(self):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        self.spool_path = self.tmp_dir_path + '/spool'
+        os.makedirs(self.spool_path)
+        self.get_spool_path = common.get_spool_path
+        common.get_spool_path = lambda: self.spool_path
+
+    def tearDown(self):
+        common.get_spool_path = self.get_spool_path
+        shutil.rmtree(self.tmp_dir_path)
+
+
+class DrainSpoolJournalBatchesTest(TempSpoolTestCase):
+
+    def write_journal(self, lines, torn_line=None):
+        journal_fh = open(common.get_spool_journal_active_file_path(), 'wb')
+        for line in lines:
+            journal_fh.write((line + '\n').encode('utf-8'))
+        if torn_line is not None:
+            journal_fh.write(torn_line.encode('utf-8'))
+        journal_fh.close()
+
+    def test_resume_after_abandoned_consumer(self):
+        self.write_journal(['{"n": %d}' % n for n in range(5)])
+
+        batches = common.drain_spool_journal_batches(batch_size=2)
+        self.assertEqual(next(batches), ['{"n": 0}\n', '{"n": 1}\n'])
+        # Asking for the second batch commits the first one.
+        self.assertEqual(next(batches), ['{"n": 2}\n', '{"n": 3}\n'])
+        batches.close()
+
+        self.assertEqual(
+            list(common.drain_spool_journal_batches(batch_size=2)),
+            [['{"n": 2}\n', '{"n": 3}\n'], ['{"n": 4}\n']])
+        self.assertEqual(common.get_spool_journal_segment_file_paths(), [])
+
+    def test_torn_last_line(self):
+        self.write_journal(['{"n": 0}', '{"n": 1}'], torn_line='{"n": 2')
+
+        self.assertEqual(
+            list(common.drain_spool_journal_batches(batch_size=10)),
+            [['{"n": 0}\n', '{"n": 1}\n']])
+        self.assertEqual(common.get_spool_journal_segment_file_paths(), [])
+
+
+class RemoteRenameCommandTest(TempSpoolTestCase):
+
+    def run_remote_rename_command(self, target_file_path):
+        subprocess.check_call(
+            ['sh', '-c', common.get_remote_rename_command(target_file_path)],
+            env=dict(os.environ, HOME=self.tmp_dir_path), cwd=self.tmp_dir_path)
+
+    def test_tilde_path(self):
+        os.makedirs(self.tmp_dir_path + '/spool dir')
+        open(self.tmp_dir_path + '/spool dir/segment.events.gz.part', 'w').close()
+
+        self.run_remote_rename_command('~/spool dir/segment.events.gz')
+
+        self.assertEqual(os.listdir(self.tmp_dir_path + '/spool dir'), ['segment.events.gz'])
+
+    def test_absolute_path(self):
+        open(self.tmp_dir_path + '/segment.events.gz.part', 'w').close()
+
+        self.run_remote_rename_command(self.tmp_dir_path + '/segment.events.gz')
+
+        self.assertTrue(os.path.exists(self.tmp_dir_path + '/segment.events.gz'))
+
+
+class ExportEventsDbSegmentTest(TempSpoolTestCase):
+
+    def test_bytes_event_text(self):
+        import sqlite3
+
+        events_db_path = self.tmp_dir_path + '/events.db'
+        connection = sqlite3.connect(events_db_path)
+        connection.execute('CREATE TABLE event (event_id INTEGER PRIMARY KEY AUTOINCREMENT, event_text BLOB)')
+        connection.execute('INSERT INTO event (event_text) VALUES (?)', (u'{"message": "ü"}'.encode('utf-8'),))
+        connection.execute('INSERT INTO event (event_text) VALUES (?)', (u'{"message": "text"}',))
+        connection.commit()
+        connection.close()
+
+        segment_file_path = common.export_events_db_segment(events_db_path, hostname='probe')
+
+        self.assertEqual(
+            list(common.read_events_segment(segment_file_path)),
+            [(1, u'{"message": "ü"}'), (2, u'{"message": "text"}')])
+
+    def create_events_db(self, events_db_path, event_count):
+        import sqlite3
+
+        if os.path.exists(events_db_path):
+            os.remove(events_db_path)
+        connection = sqlite3.connect(events_db_path)
+        connection.execute('CREATE TABLE event (event_id INTEGER PRIMARY KEY AUTOINCREMENT, event_text BLOB)')
+        for event_number in range(event_count):
+            connection.execute('INSERT INTO event (event_text) VALUES (?)', (u'{"number": %d}' % event_number,))
+        connection.commit()
+        connection.close()
+
+    def test_recreated_events_db_with_more_events(self):
+        events_db_path = self.tmp_dir_path + '/events.db'
+        self.create_events_db(events_db_path, 30)
+        first_segment_file_path = common.export_events_db_segment(events_db_path, hostname='probe')
+
+        # Recreated with event IDs which go past the last exported one.
+        self.create_events_db(events_db_path, 40)
+        second_segment_file_path = common.export_events_db_segment(events_db_path, hostname='probe')
+
+        self.assertEqual(len(list(common.read_events_segment(first_segment_file_path))), 30)
+        self.assertEqual(
+            [event_id for event_id, event_text in common.read_events_segment(second_segment_file_path)],
+            list(range(1, 41)))
+        self.assertNotEqual(
+            common.parse_events_segment_file_name(first_segment_file_path)['generation'],
+            common.parse_events_segment_file_name(second_segment_file_path)['generation'])
+
+
+class LegacySpoolFileNamesTest(TempSpoolTestCase):
+
+    def test_state_files_are_skipped(self):
+        common.write_json_file_atomically(common.get_events_shipping_state_file_path(), {'generation': 'abc'})
+        common.write_json_file_atomically(common.get_spool_evictions_file_path(), {})
+        for file_name in ['2018-05-04T13_37_00_000000.json', '2018-05-04T13_37_01_000000.json']:
+            common.write_json_file_atomically(self.spool_path + '/' + file_name, {'msg': 'event'})
+
+        self.assertEqual(
+            common.get_legacy_spool_file_names(self.spool_path),
+            ['2018-05-04T13_37_00_000000.json', '2018-05-04T13_37_01_000000.json'])
+
+
+class BatchingLogstashSenderTest(unittest.TestCase):
+
+    def test_flush_sends_the_current_batch(self):
+        server = start_stand_in_server()
+        sender = common.BatchingLogstashSender(
+            common.LogstashConnection(*server.server_address), batch_size=100, flush_interval=30)
+        try:
+            start_time = time.time()
+            for event_number in range(3):
+                sender.put('{"n": %d}' % event_number)
+
+            self.assertTrue(sender.flush(timeout=10))
+            self.assertLess(time.time() - start_time, 10)
+            self.assertTrue(server.wait_for_event_count(3, timeout=5))
+            self.assertEqual(sender.sent_count, 3)
+        finally:
+            sender.close(timeout=5)
+            server.shutdown()
+            server.server_close()
+
+    def test_backpressure_when_logstash_is_down(self):
+        # A port on which nothing listens.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+
+        sender = common.BatchingLogstashSender(
+            common.LogstashConnection(*address), batch_size=1, flush_interval=0.1, queue_size=2, put_timeout=0.1)
+        try:
+            with self.assertRaises(common.LogstashQueueFullError):
+                for event_number in range(10):
+                    sender.put('{"n": %d}' % event_number)
+
+            self.assertFalse(sender.flush(timeout=0.2))
+            self.assertEqual(sender.sent_count, 0)
+        finally:
+            sender.close(timeout=0.2)
+
+
+class PlanSpoolEvictionTest(unittest.TestCase):
+
+    def test_info_events_are_evicted_before_errors(self):
+        entries = [
+            ('error', 10, None, 1),
+            ('info', 10, None, 1),
+            ('debug', 10, None, 1),
+            ('info', 10, None, 1),
+        ]
+
+        self.assertEqual(common.plan_spool_eviction(entries, max_events=2), (set([1, 2]), set()))
+
+    def test_exceptions_are_stripped_before_evicting_errors(self):
+        entries = [
+            ('error', 100, 10, 1),
+            ('error', 100, 10, 1),
+        ]
+
+        self.assertEqual(common.plan_spool_eviction(entries, max_bytes=110), (set(), set([0])))
+
+    def test_oldest_are_evicted_last(self):
+        entries = [
+            (None, 30, None, 3),
+            ('error', 10, None, 1),
+            ('info', 10, None, 1),
+            ('error', 10, None, 1),
+        ]
+
+        self.assertEqual(common.plan_spool_eviction(entries, max_events=1), (set([0, 1, 2]), set()))
+
+    def test_within_limits(self):
+        entries = [('info', 10, None, 1)] * 3
+
+        self.assertEqual(common.plan_spool_eviction(entries, max_bytes=30, max_events=3), (set(), set()))
+
+
+class EnforceSpoolLimitsTest(TempSpoolTestCase):
+
+    def test_journal_is_rewritten(self):
+        import json
+
+        journal_fh = open(common.get_spool_journal_active_file_path(), 'wb')
+        for level in ['info', 'error', 'info', 'error']:
+            spool_obj = {'level': level, 'msg': 'test', 'extra': {'exception': ['Traceback ' * 10], 'exception_short': 'x'}}
+            journal_fh.write((json.dumps(spool_obj) + '\n').encode('utf-8'))
+        journal_fh.close()
+        config = common.ConfigParser()
+        config.add_section('Output')
+        config.set('Output', 'spool_max_events', '2')
+
+        self.assertEqual(common.enforce_spool_limits(config, self.tmp_dir_path + '/events.db'), {'info': 2})
+
+        lines = [line for batch in common.drain_spool_journal_batches() for line in batch]
+        self.assertEqual([json.loads(line)['level'] for line in lines], ['error', 'error'])
+        self.assertEqual(common.read_json_file(common.get_spool_evictions_file_path()), {'info': 2})
+
+
+class TimeWindowedSeenSetTest(unittest.TestCase):
+
+    def test_rotation_by_capacity(self):
+        seen_set = common.TimeWindowedSeenSet(capacity=100)
+        for event_number in range(150):
+            seen_set.add('first-%d' % event_number)
+
+        # The first 100 are in the previous generation now.
+        self.assertTrue(all(seen_set.contains('first-%d' % n) for n in range(150)))
+
+        for event_number in range(100):
+            seen_set.add('second-%d' % event_number)
+
+        self.assertFalse(any(seen_set.contains('first-%d' % n) for n in range(100)))
+        self.assertTrue(all(seen_set.contains('first-%d' % n) for n in range(100, 150)))
+        self.assertTrue(all(seen_set.contains('second-%d' % n) for n in range(100)))
+
+    def test_rotation_by_time(self):
+        seen_set = common.TimeWindowedSeenSet(capacity=100, window_seconds=60)
+        seen_set.add('a')
+        seen_set._generations[0]['start_time'] -= 61
+        seen_set.add('b')
+        seen_set._generations[0]['start_time'] -= 61
+        seen_set.add('c')
+
+        self.assertFalse(seen_set.contains('a'))
+        self.assertTrue(seen_set.contains('b'))
+        self.assertTrue(seen_set.contains('c'))
+
+    def test_save_and_load(self):
+        seen_set = common.TimeWindowedSeenSet(capacity=100)
+        seen_set.add('a')
+        tmp_dir_path = tempfile.mkdtemp()
+        try:
+            seen_set.save(tmp_dir_path + '/seen_set')
+            loaded_seen_set = common.TimeWindowedSeenSet(capacity=100)
+            self.assertTrue(loaded_seen_set.load(tmp_dir_path + '/seen_set'))
+        finally:
+            shutil.rmtree(tmp_dir_path)
+
+        self.assertTrue(loaded_seen_set.contains('a'))
+        self.assertFalse(loaded_seen_set.contains('b'))
+
+
+class SummaryStatisticsTest(unittest.TestCase):
+
+    def test_percentiles_are_interpolated(self):
+        statistics = common.get_summary_statistics([7, 1, 10, 3, 5, 2, 9, 4, 8, 6])
+
+        self.assertEqual(statistics['count'], 10)
+        self.assertEqual(statistics['min'], 1)
+        self.assertAlmostEqual(statistics['median'], 5.5)
+        self.assertAlmostEqual(statistics['p90'], 9.1)
+        self.assertAlmostEqual(statistics['p95'], 9.55)
+        self.assertEqual(statistics['max'], 10)
+        self.assertAlmostEqual(statistics['stddev'], 3.0276503540974917)
+
+    def test_single_value(self):
+        statistics = common.get_summary_statistics([0.5])
+
+        self.assertEqual(
+            [statistics[name] for name in ['min', 'median', 'p90', 'p95', 'max', 'stddev']],
+            [0.5, 0.5, 0.5, 0.5, 0.5, 0.0])
+
+
+class RunProcessesByDependenciesTest(unittest.TestCase):
+
+    def test_undecorated_processes_depend_on_init(self):
+        def run_process_init(iteration_count):
+            pass
+
+        def run_process_x(iteration_count):
+            pass
+
+        @common.process_dependencies(uses_ui=False)
+        def run_process_y(iteration_count):
+            pass
+
+        run_names = []
+
+        def run_process(name, function):
+            run_names.append(name)
+            return name != 'init'
+
+        states = common.run_processes_by_dependencies(
+            [('init', run_process_init), ('x', run_process_x), ('y', run_process_y)], run_process)
+
+        self.assertEqual(states, {'init': 'failed', 'x': 'skipped', 'y': 'succeeded'})
+        self.assertEqual(sorted(run_names), ['init', 'y'])
+
+
+if __name__ == '__main__':
+    unittest.main()
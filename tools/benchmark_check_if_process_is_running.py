@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark ./check_if_process_is_running.py `find_running` against a synthetic
+process list where getting the executable path and command line is
+expensive and sometimes denied, as on a busy Windows probe. Compared to
+checking one search term per invocation with all attributes fetched for
+every process, as the script did before.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from check_if_process_is_running import find_running
+
+
+class AccessDenied(Exception):
+    pass
+
+
+class SyntheticProcess(object):
+
+    def __init__(self, name, exe, cmdline, attribute_cost, access_denied):
+        self._name = name
+        self._exe = exe
+        self._cmdline = cmdline
+        self.attribute_cost = attribute_cost
+        self.access_denied = access_denied
+
+    def _pay(self):
+        deadline = time.time() + self.attribute_cost
+        while time.time() < deadline:
+            pass
+        if self.access_denied:
+            raise AccessDenied()
+
+    def name(self):
+        return self._name
+
+    def exe(self):
+        self._pay()
+        return self._exe
+
+    def cmdline(self):
+        self._pay()
+        return self._cmdline
+
+
+def get_synthetic_processes(process_count, attribute_cost, access_denied_ratio):
+    rnd = random.Random(42)
+    processes = []
+    for i in range(process_count):
+        name = 'svc%03d.exe' % i
+        processes.append(SyntheticProcess(
+            name, 'C:/Windows/System32/' + name, [name, '-k', 'netsvcs'],
+            attribute_cost, rnd.random() < access_denied_ratio))
+
+    # Targets like on a real probe.
+    processes.insert(rnd.randrange(len(processes)), SyntheticProcess(
+        'obs64.exe', 'C:/Program Files/obs-studio/bin/64bit/obs64.exe', ['obs64.exe'], attribute_cost, False))
+    processes.insert(rnd.randrange(len(processes)), SyntheticProcess(
+        'AutoHotkey.exe', 'C:/Program Files/AutoHotkey/AutoHotkey.exe',
+        ['AutoHotkey.exe', 'c:/e2e-tests/tools/show_time_measure_tray_icon.ahk'], attribute_cost, False))
+    return processes
+
+
+def find_running_one_by_one(searches, processes):
+    """The previous implementation, run once per search term."""
+    results = {}
+    for search in searches:
+        results[search] = False
+        for p in processes:
+            if 'python' in p.name():
+                continue
+            try:
+                if search in p.exe():
+                    results[search] = True
+                    break
+                if any(search in cmd_part for cmd_part in p.cmdline()):
+                    results[search] = True
+                    break
+            except AccessDenied:
+                pass
+    return results
+
+
+def measure(function):
+    start_time = time.time()
+    result = function()
+    return result, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=300)
+    parser.add_argument('--attribute-cost-us', type=float, default=50)
+    parser.add_argument('--access-denied-ratio', type=float, default=0.3)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    processes = get_synthetic_processes(args.processes, args.attribute_cost_us / 1e6, args.access_denied_ratio)
+
+    results = []
+    for searches in [['obs64'], ['obs-studio'], ['show_time_measure_tray_icon', 'obs-studio', 'not_running']]:
+        old_result, old_duration = measure(lambda: find_running_one_by_one(searches, processes))
+        new_result, new_duration = measure(lambda: find_running(searches, processes, access_errors=(AccessDenied,)))
+        assert old_result == new_result, (old_result, new_result)
+        results.append({
+            'searches': searches,
+            'result': new_result,
+            'one_by_one_ms': round(old_duration * 1000, 2),
+            'find_running_ms': round(new_duration * 1000, 2),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for result in results:
+            print("%(searches)s: one by one %(one_by_one_ms).2f ms, find_running %(find_running_ms).2f ms" % result)
+
+
+if __name__ == '__main__':
+    main()
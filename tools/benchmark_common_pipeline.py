@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the event pipeline of ../includes/common.py on Linux:
+`store_log_event`, `process_log_events` (batched output to a local
+stand-in server), `get_log_metadata`, `merge`, `get_config` (cached and
+reloaded on every call) and `get_enabled_processes_as_set` for different
+spool sizes.
+
+The cache, spool and config directories are created in a temporary
+directory (refer to `get_var_path`) and fact providers which start external
+processes are stubbed. Results include events/s, latency per event and
+the peak memory allocated by Python (tracemalloc, which slows down all
+phases, use --no-trace-memory for pure timing). Use --output to append
+them as one JSON line per run so that commits can be compared.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+
+sys.path.append('includes/')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+from logstash_stand_in_server import start_stand_in_server
+
+CONFIG_TEMPLATE = """
+[Meta]
+monitoring=false
+
+[Environment]
+tier=staging
+custom_text=Benchmark
+
+[benchmark]
+enabled_processes=
+        init
+        x
+        y ; Disabled.
+        z
+
+[Output]
+logstash=true
+logstash_host=%(host)s
+logstash_port=%(port)d
+logstash_output_mode=batched
+logstash_via_scp=false
+"""
+
+EXAMPLE_EXTRA = {
+    'tags': [],
+    'meta': {'km_processes': ['init', 'x']},
+    'data': dict(('e2e-benchmark-x-%02d-response_time_1' % i, 0.5 + i) for i in range(10)),
+}
+
+
+def stub_fact_providers():
+    common.get_os_release_id_cached = lambda: '1803'
+    common.run_check_if_running_as_vm_imvirt_cached = lambda: True
+    common.get_git_commit_hash_cached = lambda: '0' * 40
+
+
+def measure(name, spool_size, count, function, trace_memory):
+    """Run `function` which handles `count` events/calls and return the result record."""
+    if trace_memory:
+        tracemalloc.start()
+
+    start_time = time.time()
+    function()
+    duration = time.time() - start_time
+
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'function': name,
+        'spool_size': spool_size,
+        'count': count,
+        'seconds': round(duration, 4),
+        'per_second': round(count / max(duration, 1e-9), 1),
+        'latency_us': round(duration / count * 1e6, 2),
+        'peak_memory_kib': None if peak_memory is None else peak_memory // 1024,
+    }
+
+
+def run_benchmarks(spool_size, max_calls, trace_memory):
+    server = start_stand_in_server()
+    host, port = server.server_address
+
+    tmp_dir_path = tempfile.mkdtemp()
+    os.environ['E2E_TESTS_VAR_PATH'] = tmp_dir_path + '/var'
+    os.environ['E2E_TESTS_CONFIG_PATH'] = tmp_dir_path + '/config'
+    os.makedirs(tmp_dir_path + '/config')
+    with open(tmp_dir_path + '/config/default.ini', 'w') as config_fh:
+        config_fh.write(CONFIG_TEMPLATE % {'host': host, 'port': port})
+
+    results = []
+    try:
+        def store_log_events():
+            for i in range(spool_size):
+                common.store_log_event('info', 'benchmark event', common.copy_nested_dicts(EXAMPLE_EXTRA))
+
+        results.append(measure('store_log_event', spool_size, spool_size, store_log_events, trace_memory))
+
+        def process_log_events():
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                common.process_log_events()
+            server.wait_for_event_count(spool_size)
+
+        results.append(measure('process_log_events', spool_size, spool_size, process_log_events, trace_memory))
+        results[-1]['received'] = server.event_count
+
+        config = common.get_config()
+        static_log_metadata = common.get_static_log_metadata(config)
+        call_count = min(spool_size, max_calls)
+
+        def get_log_metadata():
+            for i in range(call_count):
+                common.get_log_metadata(common.copy_nested_dicts(EXAMPLE_EXTRA), config, static_log_metadata=static_log_metadata)
+
+        results.append(measure('get_log_metadata', spool_size, call_count, get_log_metadata, trace_memory))
+
+        merge_targets = [common.copy_nested_dicts(static_log_metadata) for i in range(call_count)]
+
+        def merge():
+            for merge_target in merge_targets:
+                common.merge(merge_target, EXAMPLE_EXTRA)
+
+        results.append(measure('merge', spool_size, call_count, merge, trace_memory))
+
+        def get_config():
+            for i in range(call_count):
+                common.get_config()
+
+        results.append(measure('get_config', spool_size, call_count, get_config, trace_memory))
+
+        # What every call cost before the config was cached.
+        def get_config_reload():
+            for i in range(call_count):
+                common.config_cache.pop('file_path', None)
+                common.get_config(reload=True)
+
+        results.append(measure('get_config_reload', spool_size, call_count, get_config_reload, trace_memory))
+
+        def get_enabled_processes_as_set():
+            for i in range(call_count):
+                common.get_enabled_processes_as_set('benchmark')
+
+        results.append(measure('get_enabled_processes_as_set', spool_size, call_count, get_enabled_processes_as_set, trace_memory))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir_path)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--spool-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument(
+        '--max-calls', type=int, default=10000,
+        help="Upper limit of calls for the functions which do not handle the spool.")
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false')
+    parser.add_argument('--output', help="Append the results as JSON line to this file.")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    stub_fact_providers()
+
+    run = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'commit_hash': common.get_git_commit_hash(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'trace_memory': args.trace_memory,
+        'results': [],
+    }
+    for spool_size in args.spool_sizes:
+        run['results'].extend(run_benchmarks(spool_size, args.max_calls, args.trace_memory))
+
+    if args.output:
+        with open(args.output, 'a') as output_fh:
+            output_fh.write(json.dumps(run, sort_keys=True) + '\n')
+
+    if args.json:
+        print(json.dumps(run, indent=2, sort_keys=True))
+    else:
+        for result in run['results']:
+            print("%(function)s, spool size %(spool_size)d: %(count)d in %(seconds).3f s,"
+                  " %(per_second).1f/s, %(latency_us).2f us each, peak %(peak_memory_kib)s KiB" % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the throughput of the logstash_async handler with the batching
+handler (`logstash_output_mode=batched`) against a local stand-in server.
+The measured time is from the first logged event until the server received
+the last one.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.append('includes/')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+from logstash_stand_in_server import start_stand_in_server
+
+EXAMPLE_EXTRA = {
+    '#source': 'e2e-tests',
+    'env': {'location_id': 'xxxx', 'managed_network': True},
+    'meta': {'test': 'benchmark', 'commit_hash': 'abcdef0'},
+    'data': dict(('e2e-benchmark-x-%02d-response_time_1' % i, 0.5 + i) for i in range(10)),
+}
+
+
+def get_async_handler(host, port, database_path):
+    logstash_handler = common.AsynchronousLogstashHandler(host, port, database_path=database_path)
+    logstash_handler.formatter = common.LogstashFormatter(extra_prefix=None)
+    return logstash_handler
+
+
+def get_batching_handler(host, port, zlib_framing):
+    logstash_handler = common.BatchingLogstashHandler(common.BatchingLogstashSender(
+        common.LogstashConnection(host, port),
+        zlib_framing=zlib_framing,
+    ))
+    logstash_handler.formatter = common.LogstashFormatter(extra_prefix=None)
+    return logstash_handler
+
+
+def run_benchmark(name, event_count, zlib_framing, get_handler):
+    server = start_stand_in_server(zlib_framing=zlib_framing)
+    host, port = server.server_address
+
+    logstash_handler = get_handler(host, port)
+    logger = logging.getLogger('benchmark_' + name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logstash_handler)
+
+    start_time = time.time()
+    for i in range(event_count):
+        logger.info('benchmark event', extra=EXAMPLE_EXTRA)
+    complete = server.wait_for_event_count(event_count)
+    duration = time.time() - start_time
+
+    logger.removeHandler(logstash_handler)
+    logstash_handler.close()
+    server.shutdown()
+    server.server_close()
+
+    return {
+        'name': name,
+        'events': event_count,
+        'received': server.event_count,
+        'complete': complete,
+        'duration': round(duration, 3),
+        'events_per_second': round(server.event_count / duration, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    tmp_dir_path = tempfile.mkdtemp()
+    try:
+        results = [
+            run_benchmark('logstash_async', args.events, False,
+                          lambda host, port: get_async_handler(host, port, tmp_dir_path + '/events.db')),
+            run_benchmark('batched', args.events, False,
+                          lambda host, port: get_batching_handler(host, port, False)),
+            run_benchmark('batched_zlib', args.events, True,
+                          lambda host, port: get_batching_handler(host, port, True)),
+        ]
+    finally:
+        shutil.rmtree(tmp_dir_path)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("%(name)s: %(received)d/%(events)d events in %(duration).2f s, %(events_per_second).1f events/s" % result)
+
+
+if __name__ == '__main__':
+    main()
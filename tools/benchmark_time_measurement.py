@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark for common.TimeMeasurement as used by
+start_time_measurement/stop_time_measurement in sikulix_common.
+Measures busy-waits of known length with simulated instrumentation
+overhead (process check and tray icon hotkey) around them and reports the
+error of the raw and the corrected duration.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import sys
+import json
+import argparse
+
+sys.path.append('includes/')
+import common
+
+
+def busy_wait(seconds):
+    deadline = common.get_monotonic_time() + seconds
+    while common.get_monotonic_time() < deadline:
+        pass
+
+
+def measure(duration, start_overhead, stop_overhead):
+    measurement = common.TimeMeasurement()
+    busy_wait(start_overhead)
+    measurement.started()
+
+    busy_wait(duration)
+
+    measurement.stop()
+    busy_wait(stop_overhead)
+    return measurement
+
+
+def get_error_stats(errors):
+    abs_errors = sorted(abs(e) for e in errors)
+    return {
+        'mean_us': round(sum(errors) / len(errors) * 1e6, 2),
+        'median_abs_us': round(abs_errors[len(abs_errors) // 2] * 1e6, 2),
+        'max_abs_us': round(abs_errors[-1] * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repetitions', type=int, default=50)
+    parser.add_argument('--start-overhead-ms', type=float, default=5)
+    parser.add_argument('--stop-overhead-ms', type=float, default=5)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    results = {
+        'timer_overhead_us': round(common.get_timer_overhead() * 1e6, 3),
+        'durations': [],
+    }
+    for duration in [0.001, 0.01, 0.1]:
+        raw_errors = []
+        corrected_errors = []
+        for _ in range(args.repetitions):
+            measurement = measure(duration, args.start_overhead_ms / 1e3, args.stop_overhead_ms / 1e3)
+            raw_errors.append(measurement.raw_duration - duration)
+            corrected_errors.append(measurement.duration - duration)
+        results['durations'].append({
+            'duration_s': duration,
+            'raw_error': get_error_stats(raw_errors),
+            'corrected_error': get_error_stats(corrected_errors),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print("Timer overhead: %s us" % results['timer_overhead_us'])
+        for result in results['durations']:
+            print("%(duration_s)s s: raw error %(raw_error)s, corrected error %(corrected_error)s" % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,10 @@
 """
 Needed as standalone script because from SikuliX we don’t have access to the
 running processes.
+
+Checks if processes are running which contain the search terms in their
+name, executable path or command line. Exits with 0 if all search terms
+were found. Use --json to get the result per search term.
 """
 
 __license__ = 'AGPL-3.0-only'
@@ -14,39 +18,86 @@ __copyright__ = [
 ]
 
 import sys
+import json
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument("search")
-args = parser.parse_args()
 
-found_ps = False
+def find_running(searches, processes, access_errors=()):
+    """
+    Return a dict which tells for each search term if it was found.
 
-try:
-    import psutil
-except ModuleNotFoundError:
-    # Workaround in case dependency is not installed we expect that this is not
-    # a dev system.
-    sys.exit(1)
+    `processes` are psutil.Process like objects with `name`, `exe` and
+    `cmdline` methods. Names are cheap to get so all search terms are first
+    matched against them. The executable path and command line are only
+    fetched while search terms remain unmatched.
+    """
+    results = dict((search, False) for search in searches)
 
-for p in psutil.process_iter(attrs=["name", "exe", "cmdline"]):
-    if 'python' in p.name():
-        # Filter out our own process.
-        continue
+    candidates = []
+    for p in processes:
+        try:
+            name = p.name()
+        except access_errors:
+            continue
 
-    try:
-        # print(p.as_dict())
-        if args.search in p.exe():
-            found_ps = True
+        if 'python' in name:
+            # Filter out our own process.
+            continue
+
+        for search in searches:
+            if not results[search] and search in name:
+                results[search] = True
+        candidates.append(p)
+
+    unmatched = [search for search in searches if not results[search]]
+    for p in candidates:
+        if not unmatched:
             break
 
-        for cmd_part in p.cmdline():
-            if args.search in cmd_part:
-                found_ps = True
-                break
+        try:
+            # print(p.as_dict())
+            exe = p.exe() or ''
+            cmdline = p.cmdline() or []
+        except access_errors:
+            continue
+
+        for search in unmatched:
+            if search in exe or any(search in cmd_part for cmd_part in cmdline):
+                results[search] = True
+        unmatched = [search for search in unmatched if not results[search]]
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("search", nargs='+')
+    parser.add_argument("--json", action='store_true', help="Print the result per search term as JSON.")
+    args = parser.parse_args()
+
+    try:
+        import psutil
+    except ImportError:
+        # Workaround in case dependency is not installed we expect that this is not
+        # a dev system.
+        sys.exit(1)
+
+    results = find_running(
+        args.search,
+        psutil.process_iter(),
+        access_errors=(psutil.AccessDenied, psutil.NoSuchProcess),
+    )
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    elif len(args.search) == 1:
+        print("Found: " + str(results[args.search[0]]))
+    else:
+        for search in args.search:
+            print("Found " + search + ": " + str(results[search]))
+
+    sys.exit(not all(results.values()))
 
-    except psutil._exceptions.AccessDenied:
-        pass
 
-print("Found: " + str(found_ps))
-sys.exit(not found_ps)
+if __name__ == '__main__':
+    main()
@@ -24,10 +24,186 @@ import sys
 import subprocess
 import os
 import glob
-import logging
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 
 sys.path.append('includes/')
-from common import get_config, get_scp_target_dir_path, get_logstash_handler
+from common import (
+    get_config, get_config_option, get_scp_target_dir_path, get_logstash_connection,
+    parse_events_segment_file_name, verify_events_segment, read_events_segment, read_events_db,
+    read_json_file, write_json_file_atomically,
+    get_event_id_from_event_text, TimeWindowedSeenSet,
+)
+
+# Number of events per `send` call on the shared connection.
+SEND_CHUNK_SIZE = 500
+
+events_segments_state_lock = threading.Lock()
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.value += count
+
+
+duplicate_counter = Counter()
+
+in_flight_event_ids = set()
+in_flight_event_ids_lock = threading.Lock()
+
+
+def get_checkpoint_path(spool_path):
+    checkpoint_path = spool_path + '-checkpoints'
+    if not os.path.exists(checkpoint_path):
+        os.makedirs(checkpoint_path)
+
+    return checkpoint_path
+
+
+def send_chunk(connection, chunk, seen_set):
+    """
+    Send the `(event_id, event_text)` pairs of `chunk` which were not seen before.
+    IDs are only remembered once sent so that failed chunks are retried.
+    IDs which another worker is sending right now count as seen.
+    """
+    if seen_set is None:
+        return connection.send([event_text for _, event_text in chunk]), 0
+
+    new_events = []
+    chunk_event_ids = set()
+    with in_flight_event_ids_lock:
+        for event_id, event_text in chunk:
+            if event_id in chunk_event_ids or event_id in in_flight_event_ids or seen_set.contains(event_id):
+                continue
+            chunk_event_ids.add(event_id)
+            new_events.append(event_text)
+        in_flight_event_ids.update(chunk_event_ids)
+
+    try:
+        sent_count = connection.send(new_events)
+        for event_id in chunk_event_ids:
+            seen_set.add(event_id)
+    finally:
+        with in_flight_event_ids_lock:
+            in_flight_event_ids.difference_update(chunk_event_ids)
+
+    return sent_count, len(chunk) - sent_count
+
+
+def send_events(connection, events, after_event_id=0, checkpoint_function=None, seen_set=None):
+    """
+    Send `events` in chunks, dropping duplicates found in `seen_set`. After
+    each chunk, `checkpoint_function` is called with the ID of the last event
+    of the chunk so that the caller can record how far it got.
+    """
+    event_count = 0
+    chunk = []
+    chunk_last_event_id = None
+    for event_id, event_text in events:
+        if event_id <= after_event_id:
+            continue
+
+        chunk.append((get_event_id_from_event_text(event_text), event_text))
+        chunk_last_event_id = event_id
+        if len(chunk) >= SEND_CHUNK_SIZE:
+            sent_count, duplicate_count = send_chunk(connection, chunk, seen_set)
+            event_count += sent_count
+            duplicate_counter.add(duplicate_count)
+            if checkpoint_function:
+                checkpoint_function(chunk_last_event_id)
+            chunk = []
+
+    if chunk:
+        sent_count, duplicate_count = send_chunk(connection, chunk, seen_set)
+        event_count += sent_count
+        duplicate_counter.add(duplicate_count)
+        if checkpoint_function:
+            checkpoint_function(chunk_last_event_id)
+
+    return event_count
+
+
+def process_events_db(config, connection, seen_set, spool_path, database_path):
+    """
+    The ID of the last delivered event is checkpointed per file so that
+    a run which was interrupted resumes after it.
+    The file is only deleted once it is fully drained.
+    """
+    checkpoint_file_path = '%s/%s.checkpoint.json' % (get_checkpoint_path(spool_path), os.path.basename(database_path))
+    last_delivered_event_id = read_json_file(checkpoint_file_path, {}).get('last_delivered_event_id', 0)
+
+    def checkpoint(event_id):
+        write_json_file_atomically(checkpoint_file_path, {'last_delivered_event_id': event_id})
+
+    event_count = send_events(
+        connection, read_events_db(database_path, after_event_id=last_delivered_event_id),
+        checkpoint_function=checkpoint, seen_set=seen_set)
+
+    os.remove(database_path)
+    if os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+
+    return event_count
+
+
+def process_events_segments(config, connection, seen_set, spool_path, segment_file_paths):
+    """
+    Segments are shipped by probes with `logstash_via_scp_incremental`.
+    The highest delivered event ID is checkpointed per probe and events.db
+    generation after every chunk so that interrupted segments resume after
+    it and segments which are received again are not sent twice.
+    All `segment_file_paths` need to belong to the same probe and generation.
+    """
+    state_file_path = get_checkpoint_path(spool_path) + '/events_segments.json'
+    event_count = 0
+
+    for segment_file_path in segment_file_paths:
+        segment = parse_events_segment_file_name(segment_file_path)
+        if not verify_events_segment(segment_file_path):
+            print("Checksum mismatch, keeping for inspection: " + segment_file_path)
+            os.rename(segment_file_path, segment_file_path + '.corrupt')
+            continue
+
+        state_key = '%s/%s' % (segment['hostname'], segment['generation'])
+        with events_segments_state_lock:
+            last_delivered_event_id = read_json_file(state_file_path, {}).get(state_key, 0)
+
+        def checkpoint(event_id):
+            with events_segments_state_lock:
+                state = read_json_file(state_file_path, {})
+                state[state_key] = max(state.get(state_key, 0), event_id)
+                write_json_file_atomically(state_file_path, state)
+
+        if segment['last_event_id'] > last_delivered_event_id:
+            event_count += send_events(
+                connection, read_events_segment(segment_file_path),
+                after_event_id=last_delivered_event_id, checkpoint_function=checkpoint, seen_set=seen_set)
+        else:
+            print("Skipping already ingested segment: " + segment_file_path)
+
+        os.remove(segment_file_path)
+
+    return event_count
+
+
+def run_task(task):
+    process_function, config, connection, seen_set, spool_path, name, arg = task
+    start_time = time.time()
+    try:
+        event_count = process_function(config, connection, seen_set, spool_path, arg)
+    except Exception as err:
+        # The file stays in the spool directory and is retried by the next run.
+        print("%s: failed: %s" % (name, err))
+        event_count = None
+
+    return name, event_count, time.time() - start_time
 
 
 def get_and_process_events_files():
@@ -42,25 +218,63 @@ def get_and_process_events_files():
         'rsync',
         '--archive',
         '--remove-source-files',
+        # Segments which are still being uploaded.
+        '--exclude', '*.part',
         source_dir_path,
         spool_path,
     ], stdout=subprocess.PIPE)
 
-    for f in glob.glob(spool_path + '/*'):
-        print(f)
+    connection = get_logstash_connection(config)
+
+    seen_set = None
+    seen_set_file_path = get_checkpoint_path(spool_path) + '/seen_event_ids.bloom'
+    if get_config_option(config, 'Output', 'collector_deduplication', True):
+        seen_set = TimeWindowedSeenSet(
+            capacity=get_config_option(config, 'Output', 'collector_deduplication_capacity', 1000000),
+            window_seconds=get_config_option(config, 'Output', 'collector_deduplication_window_days', 7) * 24 * 3600,
+        )
+        seen_set.load(seen_set_file_path)
 
-        logstash_handler = get_logstash_handler(config, database_path=f)
+    tasks = []
+    segment_file_paths_by_probe = {}
+    for f in sorted(glob.glob(spool_path + '/*')):
+        if f.endswith('.corrupt'):
+            continue
 
-        logger = logging.getLogger(__name__)
-        logger.addHandler(logstash_handler)
+        segment = parse_events_segment_file_name(f)
+        if segment:
+            # Segments of one probe are processed in order by one worker.
+            segment_file_paths_by_probe.setdefault(
+                (segment['hostname'], segment['generation']), []).append(f)
+        else:
+            tasks.append((process_events_db, config, connection, seen_set, spool_path, f, f))
 
-        logstash_handler._start_worker_thread()
-        logstash_handler.flush()
+    for (hostname, generation), segment_file_paths in sorted(segment_file_paths_by_probe.items()):
+        segment_file_paths.sort(key=lambda f: parse_events_segment_file_name(f)['first_event_id'])
+        tasks.append((
+            process_events_segments, config, connection, seen_set, spool_path,
+            '%s/%s_%s_*.events.gz' % (spool_path, hostname, generation), segment_file_paths))
 
-        logger.removeHandler(logstash_handler)
-        logstash_handler.close()
+    pool = ThreadPool(get_config_option(config, 'Output', 'collector_worker_count', 4))
+    start_time = time.time()
+    total_event_count = 0
+    try:
+        for name, event_count, duration in pool.imap_unordered(run_task, tasks):
+            if event_count is None:
+                continue
+            total_event_count += event_count
+            print("%s: %d events in %.2f s, %.1f events/s" % (
+                name, event_count, duration, event_count / max(duration, 0.001)))
+    finally:
+        pool.close()
+        pool.join()
+        connection.close()
+        if seen_set is not None:
+            seen_set.save(seen_set_file_path)
 
-        os.remove(f)
+    duration = time.time() - start_time
+    print("Total: %d events from %d tasks in %.2f s, %.1f events/s, %d duplicates dropped" % (
+        total_event_count, len(tasks), duration, total_event_count / max(duration, 0.001), duplicate_counter.value))
 
 
 get_and_process_events_files()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Logstash `tcp` input with the `json_lines` codec.
+Counts received events instead of processing them. Used for testing and by
+./benchmark_logstash_output.py. With --zlib-framing, it reads the frames
+sent with `logstash_zlib_framing=true`, refer to
+../includes/common.py `LogstashConnection.send`.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import sys
+import time
+import struct
+import zlib
+import argparse
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class StandInRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        if self.server.zlib_framing:
+            self.handle_zlib_frames()
+        else:
+            for line in self.rfile:
+                self.server.count_events(1)
+
+    def handle_zlib_frames(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            payload = self.rfile.read(struct.unpack('>I', header)[0])
+            self.server.count_events(zlib.decompress(payload).count(b'\n'))
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, zlib_framing=False):
+        socketserver.ThreadingTCPServer.__init__(self, server_address, StandInRequestHandler)
+        self.zlib_framing = zlib_framing
+        self.event_count = 0
+        self._lock = threading.Lock()
+
+    def count_events(self, count):
+        with self._lock:
+            self.event_count += count
+
+    def wait_for_event_count(self, event_count, timeout=60):
+        deadline = time.time() + timeout
+        while self.event_count < event_count:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+
+        return True
+
+
+def start_stand_in_server(host='127.0.0.1', port=0, zlib_framing=False):
+    """Serve in a background thread. Port 0 picks a free port, refer to `server.server_address`."""
+    server = StandInServer((host, port), zlib_framing=zlib_framing)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--zlib-framing', action='store_true')
+    args = parser.parse_args()
+
+    server = start_stand_in_server(args.host, args.port, zlib_framing=args.zlib_framing)
+    print("Listening on %s:%d" % server.server_address)
+
+    last_event_count = 0
+    try:
+        while True:
+            time.sleep(5)
+            if server.event_count != last_event_count:
+                print("Received %d events, %.1f events/s" % (
+                    server.event_count, (server.event_count - last_event_count) / 5.0))
+                last_event_count = server.event_count
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
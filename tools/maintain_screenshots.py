@@ -0,0 +1,318 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Background maintenance of the screenshots taken by the tests (refer to
+`get_screenshot_path` in ../includes/common.py) which runs at low priority:
+
+* Drops screenshots of a test which look like one that was already kept
+  for the same test on the same day using a perceptual hash (difference
+  hash). Falls back to exact duplicates if Pillow is not installed.
+  Screenshots saved by the ring buffer are kept as they show the steps
+  which led to a failure.
+* Packs days older than `screenshot_archive_after_days` into one zip
+  archive per day, `screenshots/YYYY/MM/DD.zip`.
+* Deletes the oldest days until the screenshots use less than
+  `screenshot_retention_max_mb`.
+
+Where each screenshot went is recorded in `screenshots/index.json`, use
+`--lookup` to query it.
+
+Only one instance runs at a time.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import zipfile
+import argparse
+import datetime
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+sys.path.append('includes/')
+import common
+
+SCREENSHOT_FILE_NAME_REGEX = re.compile(r'\.(png|jpg)$')
+# As named by `take_screenshot` in ../includes/sikulix_common.sikuli/sikulix_common.py.
+# Screenshots taken before the test name was included have none.
+SCREENSHOT_TEST_NAME_REGEX = re.compile(
+    r'^\d{4}-\d{2}-\d{2}T\d{2}_\d{2}_\d{2}(?:_\d+)?(?:_(?P<test_name>.+))?\.(png|jpg)$')
+DAY_DIR_REGEX = re.compile(r'^(\d{4})/(\d{2})/(\d{2})$')
+
+# Screenshots might still be written by the ring buffer.
+MIN_FILE_AGE_SECONDS = 60
+
+# Width and height of the difference hash grid. 16 gives 256 bit hashes
+# which still tell apart screens that differ in a dialog text.
+IMAGE_HASH_SIZE = 16
+
+
+def lower_process_priority():
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil and hasattr(psutil, 'IDLE_PRIORITY_CLASS'):
+        process = psutil.Process()
+        process.nice(psutil.IDLE_PRIORITY_CLASS)
+        if hasattr(psutil, 'IOPRIO_VERYLOW'):
+            process.ionice(psutil.IOPRIO_VERYLOW)
+    elif hasattr(os, 'nice'):
+        os.nice(19)
+
+
+def get_image_hash_type():
+    if Image is None:
+        return 'sha256'
+    return 'dhash%d' % IMAGE_HASH_SIZE
+
+
+def get_image_hash(file_path):
+    """
+    Return a difference hash as `dhash<size>:<hex>` or the SHA-256 of the
+    file as `sha256:<hex>` if Pillow is not available.
+    """
+    if Image is None:
+        return 'sha256:' + common.get_file_sha256(file_path)
+
+    size = IMAGE_HASH_SIZE
+    image = Image.open(file_path).convert('L').resize((size + 1, size), Image.BILINEAR)
+    pixels = list(image.getdata())
+    image_hash = 0
+    for row in range(size):
+        for col in range(size):
+            image_hash = (image_hash << 1) | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return '%s:%0*x' % (get_image_hash_type(), size * size // 4, image_hash)
+
+
+def get_hash_distance(hash1, hash2):
+    """Return the number of differing bits or None if the hashes were computed differently."""
+    hash_type1, _, value1 = hash1.partition(':')
+    hash_type2, _, value2 = hash2.partition(':')
+    if hash_type1 != hash_type2 or len(value1) != len(value2):
+        return None
+    if hash_type1 == 'sha256':
+        return 0 if value1 == value2 else len(value1) * 4
+    return bin(int(value1, 16) ^ int(value2, 16)).count('1')
+
+
+def get_day_dirs(screenshots_path):
+    """Return the day directories relative to `screenshots_path`, oldest first."""
+    if not os.path.isdir(screenshots_path):
+        # No screenshots were taken yet.
+        return []
+
+    day_dirs = []
+    for year in sorted(os.listdir(screenshots_path)):
+        year_path = screenshots_path + '/' + year
+        if not os.path.isdir(year_path):
+            continue
+        for month in sorted(os.listdir(year_path)):
+            month_path = year_path + '/' + month
+            if not os.path.isdir(month_path):
+                continue
+            for day in sorted(os.listdir(month_path)):
+                day_dir = '%s/%s/%s' % (year, month, day)
+                if DAY_DIR_REGEX.match(day_dir) and os.path.isdir(screenshots_path + '/' + day_dir):
+                    day_dirs.append(day_dir)
+    return day_dirs
+
+
+def get_day_archives(screenshots_path):
+    """Return the day archives relative to `screenshots_path`, oldest first."""
+    if not os.path.isdir(screenshots_path):
+        # No screenshots were taken yet.
+        return []
+
+    day_archives = []
+    for year in sorted(os.listdir(screenshots_path)):
+        year_path = screenshots_path + '/' + year
+        if not os.path.isdir(year_path):
+            continue
+        for month in sorted(os.listdir(year_path)):
+            month_path = year_path + '/' + month
+            if not os.path.isdir(month_path):
+                continue
+            day_archives.extend(
+                '%s/%s/%s' % (year, month, f) for f in sorted(os.listdir(month_path))
+                if DAY_DIR_REGEX.match('%s/%s/%s' % (year, month, f[:-len('.zip')])) and f.endswith('.zip'))
+    return day_archives
+
+
+def get_day_date(day_dir):
+    year, month, day = DAY_DIR_REGEX.match(day_dir).groups()
+    return datetime.date(int(year), int(month), int(day))
+
+
+def dedupe_day(screenshots_path, day_dir, index, max_distance):
+    """
+    Delete screenshots similar to one kept earlier for the same test on the
+    same day. Returns the number of deleted files.
+    """
+    day_path = screenshots_path + '/' + day_dir
+    hash_type = get_image_hash_type()
+    kept_by_test_name = {}
+    deleted_count = 0
+    for file_name in sorted(os.listdir(day_path)):
+        file_path = day_path + '/' + file_name
+        if not SCREENSHOT_FILE_NAME_REGEX.search(file_name) or time.time() - os.path.getmtime(file_path) < MIN_FILE_AGE_SECONDS:
+            continue
+        if '_ring_buffer_' in file_name:
+            continue
+
+        relative_path = day_dir + '/' + file_name
+        entry = index.setdefault(relative_path, {})
+        if not entry.get('hash', '').startswith(hash_type + ':'):
+            try:
+                entry['hash'] = get_image_hash(file_path)
+            except (IOError, OSError):
+                del index[relative_path]
+                continue
+
+        match = SCREENSHOT_TEST_NAME_REGEX.match(file_name)
+        kept = kept_by_test_name.setdefault(match.group('test_name') if match else None, [])
+        for kept_path, kept_hash in kept:
+            distance = get_hash_distance(entry['hash'], kept_hash)
+            if distance is not None and distance <= max_distance:
+                os.remove(file_path)
+                index[relative_path] = {'duplicate_of': kept_path}
+                deleted_count += 1
+                break
+        else:
+            kept.append((relative_path, entry['hash']))
+
+    return deleted_count
+
+
+def archive_day(screenshots_path, day_dir, index):
+    """Move all files of `day_dir` into `day_dir`.zip. An existing archive of an interrupted run is appended to."""
+    day_path = screenshots_path + '/' + day_dir
+    archive_path = day_path + '.zip'
+
+    archive = zipfile.ZipFile(archive_path, 'a' if os.path.exists(archive_path) else 'w', zipfile.ZIP_DEFLATED)
+    try:
+        archived_names = set(archive.namelist())
+        for file_name in sorted(os.listdir(day_path)):
+            if file_name not in archived_names:
+                archive.write(day_path + '/' + file_name, file_name)
+            index.setdefault(day_dir + '/' + file_name, {})['archive'] = day_dir + '.zip'
+    finally:
+        archive.close()
+
+    shutil.rmtree(day_path)
+
+
+def get_path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(dir_path, f)) for f in file_names)
+    return size
+
+
+def enforce_retention(screenshots_path, index, max_bytes, today):
+    """Delete the oldest days until the screenshots use at most `max_bytes`. Today is never deleted."""
+    days = sorted(
+        [(get_day_date(d), d, screenshots_path + '/' + d) for d in get_day_dirs(screenshots_path)]
+        + [(get_day_date(a[:-len('.zip')]), a[:-len('.zip')], screenshots_path + '/' + a) for a in get_day_archives(screenshots_path)])
+    total_size = sum(get_path_size(path) for _, _, path in days)
+
+    deleted_days = []
+    for day_date, day_dir, path in days:
+        if total_size <= max_bytes or day_date >= today:
+            break
+
+        total_size -= get_path_size(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        for relative_path in [p for p in index if p.startswith(day_dir + '/')]:
+            del index[relative_path]
+        deleted_days.append(day_dir)
+
+    return deleted_days
+
+
+def lookup(index, relative_path):
+    """Return where the screenshot `relative_path` (YYYY/MM/DD/name) can be found now or None if it is gone."""
+    seen = set()
+    while relative_path in index and relative_path not in seen:
+        seen.add(relative_path)
+        entry = index[relative_path]
+        if 'duplicate_of' in entry:
+            relative_path = entry['duplicate_of']
+            continue
+        result = {'path': relative_path}
+        if 'archive' in entry:
+            result['archive'] = entry['archive']
+        return result
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lookup', help="Screenshot path relative to the screenshots directory, YYYY/MM/DD/name.")
+    args = parser.parse_args()
+
+    screenshots_path = common.get_screenshots_root_path()
+    index_file_path = common.get_screenshot_index_file_path()
+    index = common.read_json_file(index_file_path, default={})
+
+    if args.lookup:
+        print(json.dumps(lookup(index, args.lookup)))
+        return
+
+    if not os.path.isdir(screenshots_path):
+        print("No screenshots in " + screenshots_path)
+        return
+
+    lock_fh = common.try_lock_file(common.get_spool_path() + '/maintain_screenshots.lock')
+    if lock_fh is None:
+        return
+
+    try:
+        lower_process_priority()
+
+        config = common.get_config()
+        max_distance = common.get_config_option(config, 'Screenshots', 'screenshot_dedupe_max_distance', 0)
+        archive_after_days = common.get_config_option(config, 'Screenshots', 'screenshot_archive_after_days', 7)
+        max_bytes = common.get_config_option(config, 'Screenshots', 'screenshot_retention_max_mb', 1024) * 1024 * 1024
+
+        today = datetime.date.today()
+        deleted_count = 0
+        archived_days = []
+        for day_dir in get_day_dirs(screenshots_path):
+            deleted_count += dedupe_day(screenshots_path, day_dir, index, max_distance)
+            if (today - get_day_date(day_dir)).days > archive_after_days:
+                archive_day(screenshots_path, day_dir, index)
+                archived_days.append(day_dir)
+            common.write_json_file_atomically(index_file_path, index)
+
+        deleted_days = enforce_retention(screenshots_path, index, max_bytes, today)
+        common.write_json_file_atomically(index_file_path, index)
+
+        print("Deleted %d duplicates, archived %d days, deleted %d days for retention." % (
+            deleted_count, len(archived_days), len(deleted_days)))
+    finally:
+        common.unlock_file(lock_fh)
+
+
+if __name__ == '__main__':
+    main()
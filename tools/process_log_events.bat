@@ -2,4 +2,4 @@
 
 setlocal
 cd /d %~dp0/..
-/Python27/python.exe "tools/process_log_events.py"
+/Python27/python.exe "tools/process_log_events.py" %*
@@ -2,10 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import argparse
 # import time
 
 sys.path.append('includes/')
 import common
 
-common.process_log_events()
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--catch-up', action='store_true',
+    help="Drain a large backlog in rate limited batches and only report progress.")
+args = parser.parse_args()
+
+common.process_log_events(catch_up=args.catch_up)
 # time.sleep(5)
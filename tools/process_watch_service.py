@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Long-running service which keeps a table of the running processes and
+answers whether a process is running over a local TCP socket.
+This avoids starting ./check_if_process_is_running.py (and walking all
+processes) for every check. Refer to `run_check_if_process_is_running_cached`
+in ../includes/common.py for the client.
+
+Protocol: The client sends the search term terminated by a newline. The
+service answers with "1\n" if a process with the search term in its name,
+executable path or command line is running, "0\n" otherwise. Multiple
+queries can be sent over one connection.
+
+Only one instance can run, further instances exit because the port is in use.
+"""
+
+__license__ = 'AGPL-3.0-only'
+__copyright__ = [
+    'Copyright (C) 2026 Geberit Verwaltungs GmbH https://www.geberit.de',
+]
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import psutil
+
+sys.path.append('includes/')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common import PROCESS_WATCH_SERVICE_ADDRESS
+from check_if_process_is_running import find_running
+
+
+class CachedProcess(object):
+    """
+    psutil.Process like view of a `ProcessTable` entry for `find_running`.
+    `exe` and `cmdline` raise psutil.AccessDenied if they were not readable.
+    """
+
+    def __init__(self, name, exe, cmdline):
+        self._name = name
+        self._exe = exe
+        self._cmdline = cmdline
+
+    def name(self):
+        return self._name
+
+    def exe(self):
+        if self._exe is None:
+            raise psutil.AccessDenied()
+        return self._exe
+
+    def cmdline(self):
+        if self._cmdline is None:
+            raise psutil.AccessDenied()
+        return self._cmdline
+
+
+class ProcessTable(object):
+    """
+    Process attributes by PID and creation time, so that a PID which was
+    reused by a new process is not answered with the attributes of the old one.
+    `refresh` only fetches the attributes of new processes and drops the
+    ones which exited, so it is cheap to call often.
+    """
+
+    def __init__(self):
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        running_processes = {}
+        for pid in psutil.pids():
+            try:
+                p = psutil.Process(pid)
+                running_processes[(pid, p.create_time())] = p
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        keys = set(running_processes)
+        with self._lock:
+            known_keys = set(self._processes)
+
+        new_processes = {}
+        for key in keys - known_keys:
+            p = running_processes[key]
+            try:
+                name = p.name()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+            try:
+                exe = p.exe()
+                cmdline = p.cmdline()
+            except psutil.AccessDenied:
+                exe = None
+                cmdline = None
+            except psutil.NoSuchProcess:
+                continue
+
+            new_processes[key] = CachedProcess(name, exe, cmdline)
+
+        with self._lock:
+            for key in known_keys - keys:
+                del self._processes[key]
+            self._processes.update(new_processes)
+
+    def is_running(self, search):
+        with self._lock:
+            processes = list(self._processes.values())
+
+        return find_running([search], processes, access_errors=(psutil.AccessDenied,))[search]
+
+
+class ProcessWatchRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            search = line.decode('utf-8').strip()
+            if not search:
+                continue
+            self.wfile.write(b'1\n' if self.server.process_table.is_running(search) else b'0\n')
+            self.wfile.flush()
+
+
+class ProcessWatchServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    # Do not allow a second instance to bind to the same port.
+    allow_reuse_address = False
+
+    def __init__(self, server_address, process_table):
+        socketserver.ThreadingTCPServer.__init__(self, server_address, ProcessWatchRequestHandler)
+        self.process_table = process_table
+
+
+def refresh_periodically(process_table, interval):
+    while True:
+        try:
+            process_table.refresh()
+        except Exception as err:
+            print("Refreshing the process table failed: %s" % err)
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--interval', type=float, default=1.0, help="Seconds between process table refreshes.")
+    args = parser.parse_args()
+
+    process_table = ProcessTable()
+    process_table.refresh()
+
+    try:
+        server = ProcessWatchServer(PROCESS_WATCH_SERVICE_ADDRESS, process_table)
+    except socket.error as err:
+        print("Not starting, another instance is probably running: %s" % err)
+        sys.exit(0)
+
+    refresh_thread = threading.Thread(target=refresh_periodically, args=(process_table, args.interval))
+    refresh_thread.daemon = True
+    refresh_thread.start()
+
+    print("Listening on %s:%d" % PROCESS_WATCH_SERVICE_ADDRESS)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+﻿rem M$ hacks. Don’t ask.
+
+setlocal
+cd /d %~dp0/..
+/Python27/python.exe "tools/ship_log_events.py"
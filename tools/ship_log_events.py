@@ -0,0 +1,14 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import sys
+
+sys.path.append('includes/')
+import common
+
+# Started in the background without a console. Keep the output for troubleshooting.
+log_fh = open(common.get_log_file_path_for_script(), 'a')
+sys.stdout = log_fh
+sys.stderr = log_fh
+
+common.ship_log_events()